@@ -0,0 +1,70 @@
+from math import isqrt
+
+# Constant-product (Uniswap V2) quotes for Katana pairs, computed locally from a
+# reserves snapshot with the same integer math of the router, so the results match
+# the contracts exactly and can be checked offline against known reserves.
+
+# 0.3% swap fee
+FEE_NUMERATOR = 997
+FEE_DENOMINATOR = 1000
+
+def get_amount_out(amount_in, reserve_in, reserve_out):
+    if amount_in <= 0:
+        raise Exception('insufficient input amount')
+    if reserve_in <= 0 or reserve_out <= 0:
+        raise Exception('insufficient liquidity')
+    amount_in_with_fee = amount_in*FEE_NUMERATOR
+    return amount_in_with_fee*reserve_out//(reserve_in*FEE_DENOMINATOR + amount_in_with_fee)
+
+# quotes for many input sizes against the same reserves
+def get_amounts_out(amounts_in, reserve_in, reserve_out):
+    return [get_amount_out(amount_in, reserve_in, reserve_out) for amount_in in amounts_in]
+
+def get_amount_in(amount_out, reserve_in, reserve_out):
+    if amount_out <= 0:
+        raise Exception('insufficient output amount')
+    if reserve_in <= 0 or reserve_out <= amount_out:
+        raise Exception('insufficient liquidity')
+    return reserve_in*amount_out*FEE_DENOMINATOR//((reserve_out - amount_out)*FEE_NUMERATOR) + 1
+
+# amount of B with the same value of amount_a, without fees (used to add liquidity)
+def quote(amount_a, reserve_a, reserve_b):
+    if amount_a <= 0:
+        raise Exception('insufficient amount')
+    if reserve_a <= 0 or reserve_b <= 0:
+        raise Exception('insufficient liquidity')
+    return amount_a*reserve_b//reserve_a
+
+# amounts actually deposited by the router addLiquidity, given the desired ones
+def get_liquidity_amounts(amount_a_desired, amount_b_desired, reserve_a, reserve_b):
+    if reserve_a == 0 and reserve_b == 0:
+        return amount_a_desired, amount_b_desired
+    amount_b_optimal = quote(amount_a_desired, reserve_a, reserve_b)
+    if amount_b_optimal <= amount_b_desired:
+        return amount_a_desired, amount_b_optimal
+    return quote(amount_b_desired, reserve_b, reserve_a), amount_b_desired
+
+def get_liquidity_minted(amount_a, amount_b, reserve_a, reserve_b, total_supply):
+    return min(amount_a*total_supply//reserve_a, amount_b*total_supply//reserve_b)
+
+# Part of amount_in to swap so that the output and the remaining input can be added
+# as liquidity with no leftover, solving
+#   (amount_in - s)/(reserve_in + s) = get_amount_out(s, reserve_in, reserve_out)/(reserve_out - out)
+# for the 0.3% fee.
+def get_optimal_swap_amount(amount_in, reserve_in):
+    return (isqrt(reserve_in*(reserve_in*3988009 + amount_in*3988000)) - reserve_in*1997)//1994
+
+# Sizing of a single-sided deposit of amount_in (swap part of it, then add liquidity),
+# all from one reserves snapshot. Returns the amount to swap, the swap output, the
+# amounts added as liquidity and the liquidity minted.
+def size_single_sided_deposit(amount_in, reserve_in, reserve_out, total_supply):
+    amount_to_swap = get_optimal_swap_amount(amount_in, reserve_in)
+    amount_out = get_amount_out(amount_to_swap, reserve_in, reserve_out)
+
+    # reserves after the swap
+    reserve_in += amount_to_swap
+    reserve_out -= amount_out
+
+    amount_in_added, amount_out_added = get_liquidity_amounts(amount_in - amount_to_swap, amount_out, reserve_in, reserve_out)
+    liquidity = get_liquidity_minted(amount_in_added, amount_out_added, reserve_in, reserve_out, total_supply)
+    return amount_to_swap, amount_out, amount_in_added, amount_out_added, liquidity
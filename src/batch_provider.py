@@ -0,0 +1,101 @@
+from threading import Lock, Event, Timer
+from concurrent.futures import ThreadPoolExecutor
+from web3 import HTTPProvider
+from web3._utils.request import make_post_request
+import json
+
+# HTTP provider that sends the reads issued within the same window as a single
+# JSON-RPC batch array, and hands each response back to its caller.
+#
+# web3 calls are synchronous, so requests only overlap when issued by different
+# threads (restakers hosted together, the block index fetches, the receipt poller).
+# batch(*funcs) runs independent web3 calls in threads, so they are sent together.
+# Methods with side effects (e.g. eth_sendRawTransaction) are never batched.
+class BatchHTTPProvider(HTTPProvider):
+    _batched_methods = set(['eth_blockNumber', 'eth_gasPrice', 'eth_getBalance', 'eth_getBlockByNumber',
+                            'eth_getBlockByHash', 'eth_getTransactionCount', 'eth_getTransactionReceipt',
+                            'eth_getTransactionByHash', 'eth_call', 'eth_chainId', 'eth_estimateGas'])
+
+    def __init__(self, endpoint_uri = None, request_kwargs = None, window = 0.005, max_requests = 100, **kwargs):
+        super().__init__(endpoint_uri, request_kwargs, **kwargs)
+        self.window = window
+        self.max_requests = max_requests
+
+        self._lock = Lock()
+        self._pending = []
+        self._timer = None
+
+    def make_request(self, method, params):
+        if method not in BatchHTTPProvider._batched_methods:
+            return super().make_request(method, params)
+
+        request = BatchHTTPProvider._Request(self.encode_rpc_request(method, params))
+        with self._lock:
+            self._pending.append(request)
+            if len(self._pending) >= self.max_requests:
+                self._start_timer(0) # full batch: no need to wait
+            elif self._timer is None:
+                self._start_timer(self.window)
+
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.response
+
+    def _start_timer(self, interval):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = Timer(interval, self._flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _flush(self):
+        with self._lock:
+            pending = self._pending[:self.max_requests]
+            self._pending = self._pending[self.max_requests:]
+            self._timer = None
+            if len(self._pending) > 0:
+                self._start_timer(0)
+
+        if len(pending) > 0:
+            self._execute(pending)
+
+    def _execute(self, batch):
+        try:
+            if len(batch) == 1:
+                responses = [self.decode_rpc_response(self._post(batch[0].data))]
+            else:
+                responses = self.decode_rpc_response(self._post(b'[' + b','.join([request.data for request in batch]) + b']'))
+                # a batch with an invalid JSON-RPC request may get a single error object
+                if not isinstance(responses, list):
+                    raise Exception('invalid batch response: {}'.format(responses))
+        except Exception as e:
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+
+        # responses may come in any order
+        responses_by_id = {response.get('id'): response for response in responses}
+        for request in batch:
+            request.response = responses_by_id.get(request.id)
+            if request.response is None:
+                request.error = Exception('no response to JSON-RPC request {}'.format(request.id))
+            request.done.set()
+
+    def _post(self, data):
+        return make_post_request(self.endpoint_uri, data, **self.get_request_kwargs())
+
+    # runs independent web3 calls (functions with no arguments) at once, so their
+    # requests are sent in the same batch. Returns their results, in order.
+    def batch(self, *funcs):
+        with ThreadPoolExecutor(max_workers = len(funcs)) as executor:
+            return [future.result() for future in [executor.submit(func) for func in funcs]]
+
+    class _Request:
+        def __init__(self, data):
+            self.data = data
+            self.id = json.loads(data)['id']
+            self.response = None
+            self.error = None
+            self.done = Event()
@@ -0,0 +1,47 @@
+from web3 import Web3
+from eth_abi import encode, decode
+from timeit import timeit
+import os
+import utils
+
+# compare the per-call cost of encoding/decoding multicall sub-calls with and without
+# the memoized FunctionCodec. No RPC is needed: the contract is created offline.
+
+def encode_uncached(call, args):
+    return utils.get_selector(call) + encode(utils.get_input_signature(call), args)
+
+def decode_uncached(call, data):
+    return decode(utils.get_output_signature(call), data)
+
+def encode_cached(call, args):
+    return utils.get_function_codec(call).encode(args)
+
+def decode_cached(call, data):
+    return utils.get_function_codec(call).decode(data)
+
+if __name__ == "__main__":
+    with open(os.path.join(os.path.dirname(__file__), 'abi', 'erc20_staking_manager_abi.json')) as f:
+        abi = f.read()
+
+    w3 = Web3()
+    addr = Web3.to_checksum_address('0x8bd81a19420bad681b7bfc20e703ebd8e253782d')
+    contract = w3.eth.contract(address = addr, abi = abi)
+
+    # bounded call, as used by Multicall2.aggregate
+    bounded = contract.functions.userRewardInfo(addr, addr)
+    # unbounded function, which needs the abi scan and the keccak hash
+    unbounded = contract.functions.userRewardInfo
+    args = (addr, addr)
+
+    data = encode(['uint256', 'uint256', 'uint256'], [1, 2, 3])
+
+    N = 20000
+    for name, call in [('bounded', bounded), ('unbounded', unbounded)]:
+        t_enc_uncached = timeit(lambda: encode_uncached(call, args), number = N)/N
+        t_enc_cached = timeit(lambda: encode_cached(call, args), number = N)/N
+        t_dec_uncached = timeit(lambda: decode_uncached(call, data), number = N)/N
+        t_dec_cached = timeit(lambda: decode_cached(call, data), number = N)/N
+
+        print('{} function:'.format(name))
+        print('  encode: {:.2f} us -> {:.2f} us ({:.1f}x)'.format(1e6*t_enc_uncached, 1e6*t_enc_cached, t_enc_uncached/t_enc_cached))
+        print('  decode: {:.2f} us -> {:.2f} us ({:.1f}x)'.format(1e6*t_dec_uncached, 1e6*t_dec_cached, t_dec_uncached/t_dec_cached))
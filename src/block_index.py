@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from filelock import FileLock
+from array import array
+from time import time
+import os
+
+# Compact local index of block number -> timestamp, persisted to disk.
+#
+# Known blocks are kept sorted in two arrays, filled lazily: missing timestamps are
+# fetched in batches (get_block requests issued concurrently) and timestamps already
+# known by other means (e.g. from a multicall) can be added for free. Timestamps of
+# unknown blocks can be interpolated, and the block at a given time is found with an
+# interpolation search, which converges in one or two rounds when the block time is
+# nearly constant.
+#
+# The file is shared by the processes in the same directory: saves are at most every
+# save_interval seconds, merge the blocks saved by the other processes and replace the
+# file atomically. Above max_blocks, the older half of the index is thinned (every other
+# block dropped), so recent blocks stay dense and the file size is bounded.
+class BlockTimestampIndex:
+    def __init__(self, eth, filename = 'block_index.bin', max_workers = 8, max_blocks = 100000, save_interval = 60):
+        self.eth = eth
+        self.filename = filename
+        self.max_workers = max_workers
+        self.max_blocks = max_blocks
+        self.save_interval = save_interval
+
+        self._lock = Lock()
+        self._blocks = array('q')
+        self._timestamps = array('q')
+        self._saved = 0
+        self._dirty = False
+        with FileLock(self.filename + '.lock'):
+            self._blocks, self._timestamps = self._read()
+
+    def _read(self):
+        pairs = array('q')
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+            # whole pairs only
+            pairs.frombytes(data[:len(data)//(2*pairs.itemsize)*2*pairs.itemsize])
+        return pairs[0::2], pairs[1::2]
+
+    def _thin(self):
+        while len(self._blocks) > self.max_blocks:
+            half = len(self._blocks)//2
+            self._blocks = self._blocks[0:half:2] + self._blocks[half:]
+            self._timestamps = self._timestamps[0:half:2] + self._timestamps[half:]
+
+    def _save(self):
+        if not self._dirty or time() - self._saved < self.save_interval:
+            return
+
+        with FileLock(self.filename + '.lock'):
+            for block, timestamp in zip(*self._read()):
+                self._add(block, timestamp)
+            self._thin()
+
+            pairs = array('q', [0])*(2*len(self._blocks))
+            pairs[0::2] = self._blocks
+            pairs[1::2] = self._timestamps
+            with open(self.filename + '.tmp', 'wb') as f:
+                pairs.tofile(f)
+            os.replace(self.filename + '.tmp', self.filename)
+
+        self._saved = time()
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def _add(self, block, timestamp):
+        idx = bisect_left(self._blocks, block)
+        if idx < len(self._blocks) and self._blocks[idx] == block:
+            return
+        self._blocks.insert(idx, block)
+        self._timestamps.insert(idx, timestamp)
+        self._dirty = True
+
+    def add(self, block, timestamp, save = True):
+        with self._lock:
+            self._add(block, timestamp)
+            if save:
+                self._save()
+
+    def _get_known(self, block):
+        idx = bisect_left(self._blocks, block)
+        if idx < len(self._blocks) and self._blocks[idx] == block:
+            return self._timestamps[idx]
+        return None
+
+    def get_timestamp(self, block):
+        return self.get_timestamps([block])[0]
+
+    def get_timestamps(self, blocks):
+        with self._lock:
+            missing = list(set([block for block in blocks if self._get_known(block) is None]))
+
+        if len(missing) > 0:
+            with ThreadPoolExecutor(max_workers = min(self.max_workers, len(missing))) as executor:
+                timestamps = list(executor.map(lambda block: self.eth.get_block(block)['timestamp'], missing))
+            with self._lock:
+                for block, timestamp in zip(missing, timestamps):
+                    self._add(block, timestamp)
+                self._save()
+
+        with self._lock:
+            return [self._get_known(block) for block in blocks]
+
+    # interpolated (or extrapolated) timestamp, without any RPC
+    def estimate_timestamp(self, block):
+        with self._lock:
+            if len(self._blocks) < 2:
+                raise Exception('not enough blocks in the index')
+            idx = min(max(bisect_left(self._blocks, block), 1), len(self._blocks) - 1)
+            b0, b1 = self._blocks[idx - 1], self._blocks[idx]
+            t0, t1 = self._timestamps[idx - 1], self._timestamps[idx]
+        return t0 + (t1 - t0)*(block - b0)/(b1 - b0)
+
+    # last block with timestamp <= t
+    def get_block_at_time(self, t):
+        with self._lock:
+            idx = bisect_right(self._timestamps, t)
+            lo = self._blocks[idx - 1] if idx > 0 else None
+            hi = self._blocks[idx] if idx < len(self._blocks) else None
+
+        if hi is None:
+            latest = self.eth.get_block('latest')
+            self.add(latest['number'], latest['timestamp'])
+            if latest['timestamp'] <= t:
+                return latest['number']
+            hi = latest['number']
+        if lo is None:
+            lo = 0
+            if self.get_timestamp(lo) > t:
+                raise Exception('time before the first block')
+
+        while hi - lo > 1:
+            t_lo, t_hi = self.get_timestamps([lo, hi])
+            guess = lo + round((t - t_lo)*(hi - lo)/(t_hi - t_lo))
+            guess = min(max(guess, lo + 1), hi - 1)
+
+            # probing the guess and the next block at once usually ends the search
+            t_guess, t_next = self.get_timestamps([guess, guess + 1])
+            if t_guess <= t < t_next:
+                return guess
+            if t_guess <= t:
+                lo = guess + 1 if t_next <= t else guess
+            else:
+                hi = guess
+
+        return lo
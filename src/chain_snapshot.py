@@ -0,0 +1,63 @@
+from collections import namedtuple
+from multicall_coalescer import MulticallCoalescer
+
+# Everything a strategy decision needs, read at one block: block number and timestamp,
+# wallet RON balance, the reserves used for prices and sizing and, when the reward
+# model must be reseeded, the staking state. It's a single multicall, sent in the same
+# JSON-RPC batch as the gas price (which can't be read from a contract). So it doesn't
+# go through the coalescer of the supervisor, if any, which would delay it by its window.
+#
+# state: the multicall record, with the fields of Restaker._get_price_calls (and of
+# RewardModel.get_staking_calls when reseeded). staking_state: the reward model state,
+# fresh or projected to the snapshot block.
+ChainSnapshot = namedtuple('ChainSnapshot', ['block_number', 'timestamp', 'gas_price', 'ron_balance', 'state', 'staking_state'])
+
+class ChainSnapshotReader:
+    def __init__(self, restaker, reward_model):
+        self.restaker = restaker
+        self.reward_model = reward_model
+        self._plan = None
+        self._last_block = None
+
+    def _get_base_calls(self):
+        restaker = self.restaker
+        calls = {'timestamp': restaker.multicall2.contract.functions.getCurrentBlockTimestamp(),
+                 'ron_balance': restaker.multicall2.contract.functions.getRonBalance(restaker.wallet.address)}
+        calls.update(restaker._get_price_calls())
+        return calls
+
+    def _get_multicall2(self):
+        multicall2 = self.restaker.multicall2
+        return multicall2.multicall2 if isinstance(multicall2, MulticallCoalescer) else multicall2
+
+    def _get_plan(self, with_staking_state):
+        restaker = self.restaker
+        if not with_staking_state:
+            if self._plan is None:
+                self._plan = self._get_multicall2().plan('ChainState', **self._get_base_calls())
+            return self._plan
+
+        # the reward per block is read at the previous snapshot block, as the snapshot
+        # block isn't known in advance. It only changes on rare pool updates.
+        if self._last_block is None:
+            self._last_block = restaker.ronin_chain.eth.block_number
+        return self._get_multicall2().plan('ChainState', **self._get_base_calls(),
+                                           **self.reward_model.get_staking_calls(self._last_block))
+
+    def read(self):
+        restaker = self.restaker
+        eth = restaker.ronin_chain.eth
+
+        with_staking_state = not self.reward_model.is_valid()
+        plan = self._get_plan(with_staking_state)
+        state, gas_price = restaker.ronin_chain.provider.batch(plan.execute, lambda: eth.gas_price)
+
+        self._last_block = state.block_number
+        restaker.block_index.add(state.block_number, state.timestamp)
+
+        if with_staking_state:
+            staking_state = self.reward_model.seed_from(state)
+        else:
+            staking_state = self.reward_model.project(state.timestamp, state.block_number)
+
+        return ChainSnapshot(state.block_number, state.timestamp, gas_price, state.ron_balance, state, staking_state)
@@ -0,0 +1,47 @@
+from threading import Lock
+import json
+import os
+import utils
+
+# Process-wide registry of ABIs and contracts.
+#
+# Each ABI file is read and parsed only once, and the parsed ABI is shared by all the
+# contracts created with it (so they also share the codecs of utils.get_function_codec).
+# Contract objects are cached per (chain, address, ABI), so creating the same contract
+# again, as done in every loop by the price functions, costs only a dict lookup.
+
+_abi_dir = os.path.join(os.path.dirname(__file__), 'abi')
+
+_abis = {}
+_contracts = {}
+_lock = Lock()
+
+# abi_file is the name of a file in the abi folder. If it is None, the abi is
+# recovered from the explorer (see utils.get_contract_abi).
+def get_abi(abi_file = None, address = None):
+    key = abi_file if abi_file is not None else ('explorer', address)
+    abi = _abis.get(key)
+    if abi is not None:
+        return abi
+
+    if abi_file is None:
+        abi = utils.get_contract_abi(address)
+    else:
+        with open(os.path.join(_abi_dir, abi_file)) as f:
+            abi = json.load(f)
+
+    with _lock:
+        # another thread may have loaded it meanwhile: keep only one parsed abi
+        return _abis.setdefault(key, abi)
+
+def get_contract(eth, address, abi_file = None):
+    key = (id(eth), address, abi_file)
+    cached = _contracts.get(key)
+    # eth is kept in the cache so its id can't be reused by another object
+    if cached is not None and cached[0] is eth:
+        return cached[1]
+
+    contract = eth.contract(address = address, abi = get_abi(abi_file, address))
+    with _lock:
+        _contracts[key] = (eth, contract)
+    return contract
@@ -0,0 +1,200 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from hexbytes import HexBytes
+import sqlite3
+import json
+import os
+import utils
+
+# Local index of contract events, as a replacement for scraping the explorer.
+#
+# Logs are pulled with eth_getLogs over block ranges, for all the sources at once. The
+# range adapts to the node: it is halved when a request fails (too many results or
+# timeout) and doubled after a successful one, up to max_range. The last indexed
+# block is checkpointed in the same SQLite database, so an update resumes from it.
+#
+# The first update goes back lookback seconds, translated to a block by the block
+# timestamp index. It only needs an eth module, so it can run against any JSON-RPC
+# node, including a local one.
+#
+# The indexers of the same database file (next to this module by default), each with
+# its own sources and checkpoint, share one connection, so their updates don't compete
+# for the SQLite write lock.
+class EventIndexer:
+    # filename -> (connection, lock)
+    _databases = {}
+    _databases_lock = Lock()
+
+    def __init__(self, eth, block_index, filename = None, name = 'default', lookback = 7*24*60*60,
+                 initial_range = 2000, min_range = 1, max_range = 50000, confirmations = 1, max_workers = 8):
+        self.eth = eth
+        self.block_index = block_index
+        self.name = name
+        self.lookback = lookback
+        self.range = initial_range
+        self.min_range = min_range
+        self.max_range = max_range
+        self.confirmations = confirmations
+        self.max_workers = max_workers
+
+        self._events = {} # (address, topic) -> contract event
+        self._lock = Lock() # one update at a time
+        filename = os.path.join(os.path.dirname(__file__), 'events.db') if filename is None else filename
+        self._db, self._db_lock = EventIndexer._open(filename)
+
+    @staticmethod
+    def _open(filename):
+        key = os.path.abspath(filename)
+        with EventIndexer._databases_lock:
+            if key not in EventIndexer._databases:
+                # other processes may be writing the same file
+                db = sqlite3.connect(key, check_same_thread = False, timeout = 30)
+                db.execute('CREATE TABLE IF NOT EXISTS events (tx_hash TEXT, log_index INTEGER, address TEXT, event TEXT, '
+                           'block_number INTEGER, args TEXT, PRIMARY KEY (tx_hash, log_index))')
+                db.execute('CREATE INDEX IF NOT EXISTS events_by_source ON events (address, event, block_number)')
+                db.execute('CREATE TABLE IF NOT EXISTS checkpoints (name TEXT PRIMARY KEY, block_number INTEGER)')
+                db.commit()
+                EventIndexer._databases[key] = (db, Lock())
+            return EventIndexer._databases[key]
+
+    def add_source(self, contract, event_names):
+        for event_name in event_names:
+            event = getattr(contract.events, event_name)()
+            self._events[(contract.address, utils.get_event_topic(event))] = event
+
+    # staking pool events of the restaker and, for Katana pools, the pair events
+    def add_restaker(self, restaker):
+        self.add_source(restaker.staking_pool, ['RewardClaimed', 'Staked', 'Unstaked'])
+        if restaker._is_staking_token_lp_token():
+            self.add_source(restaker.staking_token, ['Swap', 'Mint'])
+
+    def get_checkpoint(self):
+        with self._db_lock:
+            row = self._db.execute('SELECT block_number FROM checkpoints WHERE name = ?', (self.name,)).fetchone()
+        return None if row is None else row[0]
+
+    def _set_checkpoint(self, block_number):
+        self._db.execute('INSERT OR REPLACE INTO checkpoints (name, block_number) VALUES (?, ?)', (self.name, block_number))
+
+    def update(self, to_block = None):
+        with self._lock:
+            if len(self._events) == 0:
+                raise Exception('no event source added')
+
+            if to_block is None:
+                to_block = self.eth.block_number - self.confirmations
+
+            checkpoint = self.get_checkpoint()
+            if checkpoint is None:
+                from_block = self.block_index.get_block_at_time(self.block_index.get_timestamp(to_block) - self.lookback)
+            else:
+                from_block = checkpoint + 1
+
+            while from_block <= to_block:
+                end_block = min(from_block + self.range - 1, to_block)
+                try:
+                    logs = self.eth.get_logs(self._get_filter(from_block, end_block))
+                except Exception as e:
+                    if self.range <= self.min_range:
+                        raise e
+                    self.range = max(self.min_range, self.range//2)
+                    continue
+
+                rows = self._decode(logs)
+                with self._db_lock:
+                    self._db.executemany('INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?, ?)', rows)
+                    self._set_checkpoint(end_block)
+                    self._db.commit()
+
+                from_block = end_block + 1
+                self.range = min(self.max_range, 2*self.range)
+
+            return to_block
+
+    def _get_filter(self, from_block, to_block):
+        addresses = list(set([address for address, _ in self._events]))
+        topics = list(set([HexBytes(topic).hex() for _, topic in self._events]))
+        return {'fromBlock': from_block, 'toBlock': to_block,
+                'address': addresses, 'topics': [topics]}
+
+    def _decode(self, logs):
+        rows = []
+        for log in logs:
+            event = self._events.get((log['address'], HexBytes(log['topics'][0])))
+            # the filter matches any combination of addresses and topics
+            if event is None:
+                continue
+            decoded = event.process_log(log)
+            args = {key: EventIndexer._to_json_value(value) for key, value in decoded.args.items()}
+            rows.append((HexBytes(log['transactionHash']).hex(), log['logIndex'], log['address'],
+                         decoded.event, log['blockNumber'], json.dumps(args)))
+        return rows
+
+    @staticmethod
+    def _to_json_value(value):
+        if isinstance(value, (bytes, bytearray)):
+            return HexBytes(value).hex()
+        if isinstance(value, (list, tuple)):
+            return [EventIndexer._to_json_value(v) for v in value]
+        return value
+
+    # events newest first, with the args decoded. amounts are kept as python ints
+    def get_events(self, address = None, event = None, from_block = None, to_block = None, limit = None):
+        query = 'SELECT tx_hash, log_index, address, event, block_number, args FROM events WHERE 1=1'
+        params = []
+        for column, op, value in [('address', '=', address), ('event', '=', event),
+                                  ('block_number', '>=', from_block), ('block_number', '<=', to_block)]:
+            if value is not None:
+                query += ' AND {} {} ?'.format(column, op)
+                params.append(value)
+        query += ' ORDER BY block_number DESC, log_index DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+
+        with self._db_lock:
+            rows = self._db.execute(query, params).fetchall()
+        return [{'transactionHash': tx_hash, 'logIndex': log_index, 'address': address, 'event': event,
+                 'blockNumber': block_number, 'args': json.loads(args)}
+                for tx_hash, log_index, address, event, block_number, args in rows]
+
+    def has_transaction(self, tx_hash):
+        with self._db_lock:
+            return self._db.execute('SELECT 1 FROM events WHERE tx_hash = ? LIMIT 1', (tx_hash.lower(),)).fetchone() is not None
+
+    # Transactions of the last N calls to each function, found through the events they
+    # emit (events[i] = (address, event name) for funcs[i]), in the format of
+    # utils.scan_explorer. The receipts of the last max_candidates*N events are fetched
+    # newest first, N at a time, and only the transactions sent to the function contract
+    # are fetched, to check the selector, until N of them call the function. Fewer than
+    # N are returned when the indexed history doesn't have them.
+    def scan(self, funcs, events, N = 10, only_success = False, stop_hashes = None, max_candidates = 5):
+        self.update()
+        stop_hashes = [None]*len(funcs) if stop_hashes is None else stop_hashes
+        return [self._scan(func, address, event, N, only_success, stop_hash, max_candidates*N)
+                for func, (address, event), stop_hash in zip(funcs, events, stop_hashes)]
+
+    def _scan(self, func, address, event, N, only_success, stop_hash, limit):
+        selector = bytes(utils.get_selector(func))
+        hashes = []
+        for tx_hash in [e['transactionHash'] for e in self.get_events(address = address, event = event, limit = limit)]:
+            if tx_hash == stop_hash:
+                break
+            if tx_hash not in hashes:
+                hashes.append(tx_hash)
+
+        txns = []
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            for start in range(0, len(hashes), N):
+                chunk = hashes[start:start + N]
+                receipts = [receipt for receipt in executor.map(self.eth.get_transaction_receipt, chunk)
+                            if receipt['to'] == func.address and (not only_success or receipt['status'] == 1)]
+                inputs = executor.map(lambda receipt: HexBytes(self.eth.get_transaction(receipt['transactionHash'])['input']), receipts)
+                for receipt, data in zip(receipts, inputs):
+                    if bytes(data[:4]) != selector:
+                        continue
+                    txns.append({'transactionHash': HexBytes(receipt['transactionHash']).hex(), 'input': data.hex(),
+                                 'status': receipt['status'], 'gasUsed': receipt['gasUsed']})
+                    if len(txns) >= N:
+                        return txns
+        return txns
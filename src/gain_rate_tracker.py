@@ -0,0 +1,93 @@
+from threading import Lock
+
+# Incremental tracker of the rewards distributed by a staking pool.
+#
+# It keeps a short series of samples (block number, timestamp, cumulative rewards) and
+# advances it by querying only the rewards of the blocks added since the last sample,
+# so each update costs the block number plus one multicall pinned to that block. The
+# gain rate of each window is measured from the newest sample back to the latest sample
+# at least window seconds old, so all windows are reported from the same series.
+# Block timestamps go through the restaker block index, so no block time is assumed.
+class GainRateTracker:
+    def __init__(self, restaker, windows = {'1h': 60*60, '1d': 24*60*60, '7d': 7*24*60*60}):
+        self.restaker = restaker
+        self.windows = windows
+
+        self._lock = Lock()
+        self._samples = [] # (block_number, timestamp, cumulative_rewards), oldest first
+        self._staking_total = None
+
+    def update(self, to_block = None):
+        restaker = self.restaker
+        with self._lock:
+            if to_block is None:
+                to_block = restaker.ronin_chain.eth.block_number
+            if len(self._samples) > 0 and to_block <= self._samples[-1][0]:
+                return
+
+            if len(self._samples) == 0:
+                self._seed(to_block)
+                return
+
+            last_block, _, last_cumulative_rewards = self._samples[-1]
+            _, [rewards, staking_total, timestamp] = restaker.multicall2.aggregate([
+                    restaker.staking_manager.functions.getIntervalRewards(restaker.staking_pool.address, last_block, to_block),
+                    restaker.staking_pool.functions.getStakingTotal(),
+                    restaker.multicall2.contract.functions.getCurrentBlockTimestamp()]).call(block_identifier = to_block)
+
+            restaker.block_index.add(to_block, timestamp)
+            self._staking_total = staking_total
+            self._samples.append((to_block, timestamp, last_cumulative_rewards + rewards))
+            self._prune()
+
+    def _seed(self, to_block):
+        restaker = self.restaker
+
+        # one sample at the start of each window, plus the newest one
+        to_timestamp = restaker.block_index.get_timestamp(to_block)
+        blocks = sorted(set([restaker.block_index.get_block_at_time(to_timestamp - w) for w in self.windows.values()]))
+        blocks = [b for b in blocks if b < to_block] + [to_block]
+        timestamps = restaker.block_index.get_timestamps(blocks)
+
+        calls = [restaker.staking_manager.functions.getIntervalRewards(restaker.staking_pool.address, from_block, to_block)
+                 for from_block, to_block in zip(blocks[:-1], blocks[1:])]
+        calls += [restaker.staking_pool.functions.getStakingTotal()]
+        _, r = restaker.multicall2.aggregate(calls).call(block_identifier = to_block)
+
+        rewards = r[:-1]
+        self._staking_total = r[-1]
+
+        cumulative_rewards = 0
+        self._samples = [(blocks[0], timestamps[0], 0)]
+        for block, timestamp, reward in zip(blocks[1:], timestamps[1:], rewards):
+            cumulative_rewards += reward
+            self._samples.append((block, timestamp, cumulative_rewards))
+
+    def _prune(self):
+        # keep only the latest sample older than the longest window
+        oldest_timestamp = self._samples[-1][1] - max(self.windows.values())
+        while len(self._samples) > 2 and self._samples[1][1] <= oldest_timestamp:
+            self._samples.pop(0)
+
+    def _get_window_sample(self, window):
+        newest_timestamp = self._samples[-1][1]
+        candidates = [sample for sample in self._samples[:-1] if sample[1] <= newest_timestamp - window]
+        return candidates[-1] if len(candidates) > 0 else self._samples[0]
+
+    # gain per second of each window, for the given reward/staking token price ratio
+    def get_gain_rates(self, reward_staking_price_ratio):
+        restaker = self.restaker
+        with self._lock:
+            if len(self._samples) < 2:
+                raise Exception('gain rate tracker not updated')
+
+            _, newest_timestamp, newest_cumulative_rewards = self._samples[-1]
+            total_staking = self._staking_total*10**(-restaker.staking_token_decimals)
+
+            gain_rates = {}
+            for name, window in self.windows.items():
+                _, timestamp, cumulative_rewards = self._get_window_sample(window)
+                total_reward = (newest_cumulative_rewards - cumulative_rewards)*10**(-restaker.reward_token_decimals)
+                t = newest_timestamp - timestamp
+                gain_rates[name] = total_reward/total_staking*reward_staking_price_ratio/t
+            return gain_rates
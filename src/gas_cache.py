@@ -0,0 +1,183 @@
+from filelock import FileLock
+from bisect import bisect_left, insort
+from collections import deque
+from threading import Lock
+from time import time
+import json
+import os
+import utils
+
+# Quantiles over the last window samples. Samples are kept in arrival order (to evict
+# the oldest one) and sorted (to answer a quantile in O(1)), so memory is bounded by
+# the window. An update is a binary search plus a list insert and delete, O(window),
+# which for the window of a few dozen samples is a short memmove.
+class RollingQuantile:
+    def __init__(self, window = 50, samples = []):
+        self.window = window
+        self._samples = deque()
+        self._sorted = []
+        for sample in samples:
+            self.add(sample)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def add(self, value):
+        if len(self._samples) == self.window:
+            oldest = self._samples.popleft()
+            del self._sorted[bisect_left(self._sorted, oldest)]
+        self._samples.append(value)
+        insort(self._sorted, value)
+
+    # linear interpolation between the closest ranks, so quantile(0.5) is the median
+    def quantile(self, q):
+        if len(self._sorted) == 0:
+            raise Exception('no samples')
+        pos = q*(len(self._sorted) - 1)
+        lo = int(pos)
+        hi = min(lo + 1, len(self._sorted) - 1)
+        return self._sorted[lo] + (self._sorted[hi] - self._sorted[lo])*(pos - lo)
+
+# On-disk cache of the gas used by the last successful transactions of each contract
+# function, as seen in the explorer (or in another source with the interface of
+# utils.scan_explorer, e.g. the event indexer, given as scan).
+#
+# Each entry (contract address, selector) keeps the samples (newest first) and the hash
+# of the newest transaction seen. After the TTL expires, a refresh downloads only the
+# transactions newer than that hash, so in steady state it costs at most one explorer
+# page per function, and none at all while the entry is fresh.
+#
+# The samples of each entry also feed a RollingQuantile, which can be fed with the
+# receipts of our own transactions too (add_receipt), so the median or a high
+# percentile of the gas used is answered without re-fetching the history.
+#
+# The file (next to this module by default) is shared by the processes: before each
+# write, the entries changed more recently by the other processes are merged in. The
+# scans run outside the lock, so the refresh of some functions doesn't block the others.
+class GasUsageCache:
+    def __init__(self, filename = None, ttl = 6*60*60, max_samples = 50):
+        self.filename = os.path.join(os.path.dirname(__file__), 'gas_cache.json') if filename is None else filename
+        self.ttl = ttl
+        self.max_samples = max_samples
+
+        self._lock = Lock()
+        self._entries = self._load()
+        self._quantiles = {}
+
+    def _load(self):
+        with FileLock(self.filename + '.lock'):
+            return self._read()
+
+    def _read(self):
+        if not os.path.exists(self.filename):
+            return {}
+        with open(self.filename) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _get_modified(entry):
+        return entry.get('modified', entry['updated'])
+
+    def _save(self):
+        with FileLock(self.filename + '.lock'):
+            for key, entry in self._read().items():
+                if key not in self._entries or GasUsageCache._get_modified(entry) > GasUsageCache._get_modified(self._entries[key]):
+                    self._entries[key] = entry
+                    self._quantiles.pop(key, None)
+
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(self.filename + '.tmp', self.filename)
+
+    @staticmethod
+    def _get_key(func):
+        return '{}:{}'.format(func.address.lower(), bytes(utils.get_selector(func)).hex())
+
+    def get_gas_used(self, func, N = 10, scan = None):
+        return self.get_gas_used_many([func], N = N, scan = scan)[0]
+
+    def get_gas_used_many(self, funcs, N = 10, scan = None):
+        keys = self._update(funcs, N, scan)
+        return [self._entries[key]['samples'][:N] for key in keys]
+
+    # expired entries are refreshed together in a single scan, outside the lock. An own
+    # receipt added meanwhile is dropped with the old entry, but it's counted once anyway,
+    # when the next scan returns its transaction.
+    def _update(self, funcs, N, scan):
+        keys = [GasUsageCache._get_key(func) for func in funcs]
+        with self._lock:
+            expired = [i for i, key in enumerate(keys) if self._is_expired(self._entries.get(key), N)]
+            entries = [self._entries.get(keys[i]) for i in expired]
+        if len(expired) > 0:
+            entries = self._refresh([funcs[i] for i in expired], N, entries, scan)
+            with self._lock:
+                for i, entry in zip(expired, entries):
+                    self._entries[keys[i]] = entry
+                    self._quantiles.pop(keys[i], None)
+                self._save()
+        return keys
+
+    def _get_quantile(self, key):
+        quantile = self._quantiles.get(key)
+        if quantile is None:
+            # samples are stored newest first
+            quantile = RollingQuantile(self.max_samples, reversed(self._entries[key]['samples']))
+            self._quantiles[key] = quantile
+        return quantile
+
+    # gas used by our own successful transaction (call is the bounded function sent)
+    def add_receipt(self, call, txn_receipt):
+        if txn_receipt['status'] != 1:
+            return
+        key = GasUsageCache._get_key(call)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            # built (if needed) before adding the receipt to the samples, so it's not counted twice
+            quantile = self._get_quantile(key)
+            entry['samples'] = ([txn_receipt['gasUsed']] + entry['samples'])[:self.max_samples]
+            # the explorer will also return this transaction in the next refresh
+            entry.setdefault('own_hashes', []).append(bytes(txn_receipt['transactionHash']).hex())
+            entry['modified'] = time()
+            quantile.add(txn_receipt['gasUsed'])
+            self._save()
+
+    def _is_expired(self, entry, N):
+        return entry is None or len(entry['samples']) < N or time() - entry['updated'] > self.ttl
+
+    def _refresh(self, funcs, N, entries, scan):
+        # if there are not enough samples yet, download all of them again
+        stop_hashes = [entry['last_hash'] if entry is not None and len(entry['samples']) >= N else None for entry in entries]
+        scan = utils.scan_explorer if scan is None else scan
+        txns_list = scan(funcs, N = N, only_success = True, stop_hashes = stop_hashes)
+
+        new_entries = []
+        for txns, entry, stop_hash in zip(txns_list, entries, stop_hashes):
+            new_entry = {'last_hash': txns[0]['transactionHash'] if len(txns) > 0 else stop_hash,
+                         'updated': time()}
+            if stop_hash is None:
+                # all the samples are downloaded again, including our own transactions
+                samples = [int(tx['gasUsed']) for tx in txns]
+            else:
+                # our own transactions are already in the samples (add_receipt). The ones not
+                # returned yet are kept, to be skipped in the next refreshes.
+                own_hashes = entry.get('own_hashes', [])
+                hashes = [tx['transactionHash'].lower().replace('0x', '') for tx in txns]
+                samples = [int(tx['gasUsed']) for tx, h in zip(txns, hashes) if h not in own_hashes]
+                samples += entry['samples']
+                pending_hashes = [h for h in own_hashes if h not in hashes][-self.max_samples:]
+                if len(pending_hashes) > 0:
+                    new_entry['own_hashes'] = pending_hashes
+            new_entry['samples'] = samples[:self.max_samples]
+            new_entries.append(new_entry)
+        return new_entries
+
+    # q is the quantile of the gas used: 0.5 for the median, 0.9 for p90, ...
+    def estimate_gas_used(self, func, N = 10, q = 0.5, scan = None):
+        return self.estimate_gas_used_many([func], N = N, q = q, scan = scan)[0]
+
+    def estimate_gas_used_many(self, funcs, N = 10, q = 0.5, scan = None):
+        keys = self._update(funcs, N, scan)
+        with self._lock:
+            return [round(self._get_quantile(key).quantile(q)) for key in keys]
@@ -0,0 +1,76 @@
+from threading import Lock
+from collections import OrderedDict
+from time import time
+import requests
+from requests.adapters import HTTPAdapter
+
+# HTTP client shared by all the off-chain requests of the process (explorer, ABIs and
+# exchange rates).
+#
+# A single session keeps the connections alive in a pool, so the TLS handshake is done
+# once per host, and asks for gzip responses. GET responses are kept in a small LRU
+# cache: within max_age seconds they are served with no request and, after that, they
+# are revalidated with If-None-Match/If-Modified-Since when the server gave an ETag or
+# Last-Modified, so an unchanged resource costs a 304 with no body.
+class HttpClient:
+    _headers = {'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:95.0) Gecko/20100101 Firefox/95.0',
+                'Accept-Encoding': 'gzip, deflate'}
+
+    def __init__(self, pool_size = 16, cache_size = 128, timeout = 30):
+        self.cache_size = cache_size
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.session.headers.update(HttpClient._headers)
+        adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._lock = Lock()
+        self._cache = OrderedDict() # url -> (updated, etag, last_modified, json)
+
+    def _get_cached(self, url):
+        with self._lock:
+            entry = self._cache.get(url)
+            if entry is not None:
+                self._cache.move_to_end(url)
+            return entry
+
+    def _set_cached(self, url, entry):
+        with self._lock:
+            self._cache[url] = entry
+            self._cache.move_to_end(url)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last = False)
+
+    # parsed JSON of a GET. max_age: seconds a cached response is used without revalidation
+    def get_json(self, url, max_age = 0, timeout = None):
+        entry = self._get_cached(url)
+        if entry is not None and time() - entry[0] < max_age:
+            return entry[3]
+
+        headers = {}
+        if entry is not None and entry[1] is not None:
+            headers['If-None-Match'] = entry[1]
+        if entry is not None and entry[2] is not None:
+            headers['If-Modified-Since'] = entry[2]
+
+        r = self.session.get(url, headers = headers, timeout = self.timeout if timeout is None else timeout)
+        if r.status_code == 304 and entry is not None:
+            self._set_cached(url, (time(), entry[1], entry[2], entry[3]))
+            return entry[3]
+        r.raise_for_status()
+
+        data = r.json()
+        etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+        if max_age > 0 or etag is not None or last_modified is not None:
+            self._set_cached(url, (time(), etag, last_modified, data))
+        return data
+
+    # parsed JSON of a POST with a JSON body. Not cached.
+    def post_json(self, url, data, timeout = None):
+        r = self.session.post(url, json = data, timeout = self.timeout if timeout is None else timeout)
+        r.raise_for_status()
+        return r.json()
+
+client = HttpClient()
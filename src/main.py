@@ -1,7 +1,5 @@
-from web3 import Web3
 import keyring
-from restaker import KatanaRestaker, AXSRestaker
-from strategy import OptimalIntervalStrategy, ASAPStrategy
+from positions import create_restaker, create_strategy, parse_strategy_options
 from pwinput import pwinput
 import sys
 
@@ -20,29 +18,26 @@ import sys
 #
 # - min_ron_balance (only when using OptimalIntervalStrategy)
 #
+# options (anywhere in the args):
+#
+# - --gas-quantile=<q>: quantile of the gas used history to budget the fees (default 0.5)
+# - --pipelined: send the claim, swap and add liquidity of a Katana restake back-to-back,
+#   without waiting for each receipt
+#
 if __name__ == '__main__':
-    arg_cnt = len(sys.argv)
+    argv, strategy_options = parse_strategy_options(sys.argv)
+    arg_cnt = len(argv)
     if arg_cnt not in [1, 3, 4]:
         raise Exception('number of arguments different from 0, 2 or 3')
-    if arg_cnt == 3 and int(sys.argv[2]) == 2: # OptimalIntervalStrategy without ron min balance
+    if arg_cnt == 3 and int(argv[2]) == 2: # OptimalIntervalStrategy without ron min balance
         raise Exception('min ron balance not specified')
-    if arg_cnt == 4 and int(sys.argv[2]) == 1: # ASAPStrategy with more arguments than necessary
+    if arg_cnt == 4 and int(argv[2]) == 1: # ASAPStrategy with more arguments than necessary
         raise Exception('expected 2 arguments, received 3')
     
-    wron_usdc_lp_staking_pool_addr = Web3.to_checksum_address('0xba1c32baff8f23252259a641fd5ca0bd211d4f65')
-    wron_axs_lp_staking_pool_addr = Web3.to_checksum_address('0x14327fa6a4027d8f08c0a1b7feddd178156e9527')
-    wron_weth_lp_staking_pool_addr = Web3.to_checksum_address('0xb9072cec557528f81dd25dc474d4d69564956e1e')
-    wron_slp_lp_staking_pool_addr = Web3.to_checksum_address('0x4e2d6466a53444248272b913c105e9281ec266d8')
-
-    katana_pools = [wron_usdc_lp_staking_pool_addr,
-                    wron_axs_lp_staking_pool_addr,
-                    wron_weth_lp_staking_pool_addr,
-                    wron_slp_lp_staking_pool_addr]
-    
     option = 'n' if arg_cnt>1 else None
-    desired_pool = int(sys.argv[1]) if arg_cnt>1 else None
-    desired_strat = int(sys.argv[2]) if arg_cnt>2 else None
-    desired_min_ron_balance = float(sys.argv[3]) if arg_cnt>3 else None
+    desired_pool = int(argv[1]) if arg_cnt>1 else None
+    desired_strat = int(argv[2]) if arg_cnt>2 else None
+    desired_min_ron_balance = float(argv[3]) if arg_cnt>3 else None
 
     is_first_iter = True 
     while option not in ['y', 'n']:   
@@ -76,12 +71,7 @@ if __name__ == '__main__':
         except ValueError:
             pass
 
-    if desired_pool in [1,2,3,4]:
-        restaker = KatanaRestaker(keyring.get_password('ronin','priv_key'), katana_pools[desired_pool - 1])
-    elif desired_pool == 5:
-        restaker = AXSRestaker(keyring.get_password('ronin','priv_key'))
-    else:
-        raise Exception('unexpected option value {}'.format(desired_pool))
+    restaker = create_restaker(keyring.get_password('ronin','priv_key'), desired_pool)
     
     print('')
     print('Select desired strategy:')
@@ -100,9 +90,7 @@ if __name__ == '__main__':
         except ValueError:
             pass
 
-    if desired_strat == 1:
-        strat = ASAPStrategy(restaker)
-    elif desired_strat == 2:
+    if desired_strat == 2:
         default_min_ron_balance = 1
         is_first_iter = True
         while desired_min_ron_balance is None:
@@ -114,11 +102,8 @@ if __name__ == '__main__':
                 desired_min_ron_balance = default_min_ron_balance if input_balance == '' else float(input_balance)
             except ValueError:
                 pass
-        strat = OptimalIntervalStrategy(restaker, desired_min_ron_balance)
 
-    else:
-        raise Exception('unexpected option value {}'.format(desired_pool))
-     
+    strat = create_strategy(restaker, desired_strat, desired_min_ron_balance, strategy_options)
     strat.run()
 
 # # staking pools com recompensas
@@ -1,7 +1,8 @@
 from web3 import Web3
-from eth_abi import encode, decode
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import utils
-import os
+import contract_registry
 
 #  Observações:
 #     _encode_transaction_data poderia ser obtido por call._encode_transaction_data(),
@@ -11,15 +12,11 @@ class Multicall2:
     def __init__(self, eth, address):
         self.eth = eth
         self.address = Web3.to_checksum_address(address)
-
-        with open(os.path.join(os.path.dirname(__file__), 'abi', 'multicall2_abi.json')) as f:
-            self.contract = eth.contract(address = self.address, abi = f.read())
+        self.contract = contract_registry.get_contract(eth, self.address, 'multicall2_abi.json')
     
     @staticmethod
     def _encode_transaction_data(call):
-        selector = utils.get_selector(call)
-        data = encode(utils.get_input_signature(call), call.args)
-        return selector + data
+        return utils.get_function_codec(call).encode(call.args)
 
     @staticmethod
     def _encode_aggregate_data(calls):
@@ -29,6 +26,124 @@ class Multicall2:
         enc_data = Multicall2._encode_aggregate_data(calls)
         return Multicall2.DecodedAggregate(self.contract.functions.aggregate(enc_data), calls)
 
+    # Failure tolerant aggregate for very large batches, using tryBlockAndAggregate.
+    #
+    # The calls are split into chunks limited by the estimated gas (gas_per_call can be a
+    # number or a function of the call) and by the calldata size. All chunks are pinned to
+    # the same block: if block_identifier is 'latest', the first chunk defines the block
+    # and the others (dispatched concurrently when max_workers > 1) use its number.
+    #
+    # Returns [block_number, [(success, result), ...]], with result None for failed calls.
+    def try_aggregate(self, calls, gas_per_call = 100000, max_gas = 20000000, max_calldata = 64*1024,
+                      max_workers = 1, block_identifier = 'latest'):
+        chunks = Multicall2._split_in_chunks(calls, gas_per_call, max_gas, max_calldata)
+        if len(chunks) == 0:
+            return [None, []]
+
+        if block_identifier == 'latest':
+            block_number, first_results = self._try_block_and_aggregate(chunks[0], 'latest')
+            results = [first_results]
+            chunks = chunks[1:]
+        else:
+            block_number = block_identifier
+            results = []
+
+        if max_workers > 1 and len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers = min(max_workers, len(chunks))) as executor:
+                chunks_results = list(executor.map(lambda chunk: self._try_block_and_aggregate(chunk, block_number), chunks))
+        else:
+            chunks_results = [self._try_block_and_aggregate(chunk, block_number) for chunk in chunks]
+
+        for chunk_block_number, chunk_results in chunks_results:
+            if isinstance(block_number, int) and chunk_block_number != block_number:
+                raise Exception('chunk executed at block {}, expected {}'.format(chunk_block_number, block_number))
+            results.append(chunk_results)
+
+        return [block_number, [result for chunk_results in results for result in chunk_results]]
+
+    @staticmethod
+    def _split_in_chunks(calls, gas_per_call, max_gas, max_calldata):
+        chunks = []
+        chunk_gas = 0
+        chunk_calldata = 0
+        for call, enc_data in zip(calls, Multicall2._encode_aggregate_data(calls)):
+            gas = gas_per_call(call) if callable(gas_per_call) else gas_per_call
+            # each call costs its data plus ~3 words of abi overhead (address, offset and length)
+            calldata = len(enc_data[1]) + 3*32
+            if len(chunks) == 0 or chunk_gas + gas > max_gas or chunk_calldata + calldata > max_calldata:
+                chunks.append([])
+                chunk_gas = 0
+                chunk_calldata = 0
+            chunks[-1].append((call, enc_data))
+            chunk_gas += gas
+            chunk_calldata += calldata
+        return chunks
+
+    def _try_block_and_aggregate(self, chunk, block_identifier):
+        codec = utils.get_function_codec(self.contract.functions.tryBlockAndAggregate)
+        calldata = codec.encode([False, [enc_data for _, enc_data in chunk]])
+        raw = self.eth.call({'to': self.address, 'data': calldata}, block_identifier)
+        block_number, _, return_data = codec.decode(raw)
+
+        results = []
+        for (call, _), (success, data) in zip(chunk, return_data):
+            if success:
+                try:
+                    result = utils.get_function_codec(call).decode(data)
+                    result = result[0] if len(result)==1 else result
+                except Exception:
+                    # e.g. calls to addresses without code succeed with empty data
+                    success, result = False, None
+            else:
+                result = None
+            results.append((success, result))
+        return block_number, results
+
+    # calls given as keyword arguments, in the order of the record fields
+    def plan(self, name, **calls):
+        return Multicall2.QueryPlan(self, name, calls)
+
+    # Aggregate read compiled once: the calldata is encoded in the constructor, so each
+    # execution costs only the eth_call round trip and the decoding. Results are returned
+    # as a namedtuple with block_number and one field per call. Calls with more than one
+    # named output (like userRewardInfo) are also decoded into namedtuples.
+    class QueryPlan:
+        def __init__(self, multicall2, name, calls, coalescer = None):
+            self.multicall2 = multicall2
+            self.coalescer = coalescer
+            self.calls = list(calls.values())
+            self.record = namedtuple(name, ['block_number'] + list(calls.keys()))
+
+            self._aggregate_codec = utils.get_function_codec(multicall2.contract.functions.aggregate)
+            self._calldata = self._aggregate_codec.encode([Multicall2._encode_aggregate_data(self.calls)])
+            self._codecs = [utils.get_function_codec(call) for call in self.calls]
+            self._output_records = [Multicall2.QueryPlan._create_output_record(call) for call in self.calls]
+
+        @staticmethod
+        def _create_output_record(call):
+            names = [name.lstrip('_') for name in utils.get_output_names(call)]
+            if len(names) < 2 or len(set(names)) != len(names) or not all([name.isidentifier() for name in names]):
+                return None
+            return namedtuple(call.fn_name, names)
+
+        def _make_record(self, block_number, results):
+            values = []
+            for result, output_record in zip(results, self._output_records):
+                values.append(result if output_record is None else output_record(*result))
+            return self.record(block_number, *values)
+
+        def execute(self, block_identifier = 'latest'):
+            # reads not pinned to a block can be merged with other wallets' reads
+            if self.coalescer is not None and block_identifier == 'latest':
+                block_number, results = self.coalescer.aggregate(self.calls).call()
+                return self._make_record(block_number, results)
+
+            raw = self.multicall2.eth.call({'to': self.multicall2.address, 'data': self._calldata}, block_identifier)
+            block_number, encoded_results = self._aggregate_codec.decode(raw)
+            results = [codec.decode(data) for codec, data in zip(self._codecs, encoded_results)]
+            results = [result[0] if len(result)==1 else result for result in results]
+            return self._make_record(block_number, results)
+
     class DecodedAggregate:
         def __init__(self, func, calls):
             self.func = func
@@ -36,7 +151,7 @@ class Multicall2:
 
         def _decode_aggregate_result(self, result):
             encoded_result = result[1]
-            decoded_result = [decode(utils.get_output_signature(call), data) for data, call in zip(encoded_result, self.calls)]
+            decoded_result = [utils.get_function_codec(call).decode(data) for data, call in zip(encoded_result, self.calls)]
             decoded_result = [result[0] if len(result)==1 else result for result in decoded_result]
             return [result[0], decoded_result]
 
@@ -0,0 +1,105 @@
+from threading import Lock, Event, Timer
+from multicall2 import Multicall2
+
+# Coalesces the Multicall2 reads issued by many restakers hosted in the same process.
+#
+# Reads submitted within the same window are packed into as few aggregate calls as
+# possible and the decoded results are fanned back to each caller, so N wallets reading
+# their state at the same tick cost one RPC round trip instead of N. It has the same
+# aggregate(calls).call() interface of Multicall2, so it can replace it in a restaker.
+#
+# Batches are sent with try_aggregate, so a reverting call only fails the request that
+# made it. A caller waits at most timeout seconds for its batch.
+class MulticallCoalescer:
+    def __init__(self, multicall2, window = 0.05, max_calls = 500, timeout = 60):
+        self.multicall2 = multicall2
+        # same attributes of Multicall2, for the calls built on them (e.g. getRonBalance)
+        self.eth = multicall2.eth
+        self.address = multicall2.address
+        self.contract = multicall2.contract
+        self.window = window
+        self.max_calls = max_calls
+        self.timeout = timeout
+
+        self._lock = Lock()
+        self._pending = []
+        self._timer = None
+
+    def aggregate(self, calls):
+        return MulticallCoalescer.CoalescedAggregate(self, calls)
+
+    def plan(self, name, **calls):
+        return Multicall2.QueryPlan(self.multicall2, name, calls, coalescer = self)
+
+    def _submit(self, calls):
+        request = MulticallCoalescer._Request(calls)
+        with self._lock:
+            self._pending.append(request)
+            if self._timer is None:
+                self._timer = Timer(self.window, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+        if not request.done.wait(self.timeout):
+            raise Exception('coalesced multicall timed out')
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._timer = None
+
+        # requests are never split between batches, so a batch may exceed max_calls
+        # only when a single request does
+        batches = []
+        batch_size = 0
+        for request in pending:
+            if len(batches) == 0 or batch_size + len(request.calls) > self.max_calls:
+                batches.append([])
+                batch_size = 0
+            batches[-1].append(request)
+            batch_size += len(request.calls)
+
+        for batch in batches:
+            self._execute(batch)
+
+    def _execute(self, batch):
+        calls = [call for request in batch for call in request.calls]
+        try:
+            block_number, results = self.multicall2.try_aggregate(calls, max_workers = 4)
+        except Exception as e:
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+
+        idx = 0
+        for request in batch:
+            request_results = results[idx:idx + len(request.calls)]
+            idx += len(request.calls)
+            if all([success for success, _ in request_results]):
+                request.result = [block_number, [result for _, result in request_results]]
+            else:
+                request.error = Exception('multicall call failed')
+            request.done.set()
+
+    class _Request:
+        def __init__(self, calls):
+            self.calls = calls
+            self.result = None
+            self.error = None
+            self.done = Event()
+
+    class CoalescedAggregate:
+        def __init__(self, coalescer, calls):
+            self.coalescer = coalescer
+            self.calls = calls
+
+        def call(self, *args, **kwargs):
+            # calls pinned to a block or with custom params can't be merged with others
+            if len(args) > 0 or len(kwargs) > 0:
+                return self.coalescer.multicall2.aggregate(self.calls).call(*args, **kwargs)
+            return self.coalescer._submit(self.calls)
@@ -0,0 +1,29 @@
+from threading import Lock
+
+# Local nonces of a wallet, shared by all the restakers of the wallet in the process.
+#
+# The pending transaction count is read from the node only when the manager is out of
+# sync (first use or after reset()). After that, nonces are handed out locally, so
+# dependent transactions can be signed and sent back-to-back with consecutive nonces.
+# Other processes using the same wallet are not seen, so reset() should be called
+# whenever the wallet lock is taken (see Restaker._transaction_burst), and whenever a
+# transaction fails to be sent (the nonce would be left unused and block the next ones).
+class NonceManager:
+    def __init__(self, eth, address):
+        self.eth = eth
+        self.address = address
+
+        self._lock = Lock()
+        self._next_nonce = None
+
+    def reset(self):
+        with self._lock:
+            self._next_nonce = None
+
+    def get_nonce(self):
+        with self._lock:
+            if self._next_nonce is None:
+                self._next_nonce = self.eth.get_transaction_count(self.address, block_identifier = 'pending')
+            nonce = self._next_nonce
+            self._next_nonce += 1
+            return nonce
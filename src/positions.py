@@ -0,0 +1,45 @@
+from web3 import Web3
+from restaker import KatanaRestaker, AXSRestaker
+from strategy import OptimalIntervalStrategy, ASAPStrategy
+
+# Staking pools and strategies of the main.py and supervisor.py options.
+#
+# - pool: 1 to 4 are the Katana pools below, 5 is AXS
+# - strategy: 1 for ASAPStrategy, 2 for OptimalIntervalStrategy (with a min RON balance)
+
+katana_pools = [Web3.to_checksum_address('0xba1c32baff8f23252259a641fd5ca0bd211d4f65'), # WRON-USDC
+                Web3.to_checksum_address('0x14327fa6a4027d8f08c0a1b7feddd178156e9527'), # WRON-AXS
+                Web3.to_checksum_address('0xb9072cec557528f81dd25dc474d4d69564956e1e'), # WRON-WETH
+                Web3.to_checksum_address('0x4e2d6466a53444248272b913c105e9281ec266d8')] # WRON-SLP
+
+def create_restaker(priv_key, desired_pool):
+    if desired_pool in [1,2,3,4]:
+        return KatanaRestaker(priv_key, katana_pools[desired_pool - 1])
+    elif desired_pool == 5:
+        return AXSRestaker(priv_key)
+    else:
+        raise Exception('unexpected option value {}'.format(desired_pool))
+
+# options: strategy options parsed by parse_strategy_options
+def create_strategy(restaker, desired_strat, min_ron_balance = None, options = {}):
+    if desired_strat == 1:
+        return ASAPStrategy(restaker, **options)
+    elif desired_strat == 2:
+        if min_ron_balance is None:
+            raise Exception('min ron balance not specified')
+        return OptimalIntervalStrategy(restaker, min_ron_balance, **options)
+    else:
+        raise Exception('unexpected option value {}'.format(desired_strat))
+
+# splits the strategy options (--gas-quantile=<q>, --pipelined) from the other args
+def parse_strategy_options(args):
+    options = {}
+    other_args = []
+    for arg in args:
+        if arg.startswith('--gas-quantile='):
+            options['gas_quantile'] = float(arg.split('=', 1)[1])
+        elif arg == '--pipelined':
+            options['pipelined'] = True
+        else:
+            other_args.append(arg)
+    return other_args, options
@@ -0,0 +1,76 @@
+from threading import Lock, Thread
+from time import time
+import http_client
+
+# USD prices from the exchange rate API, cached with a TTL and shared by all the
+# restakers in the process.
+#
+# After the TTL, the cached prices are still served (stale-while-revalidate) while a
+# background thread refreshes them, up to max_stale seconds. Only when there are no
+# usable prices the request is made in the caller thread, with a short timeout. get()
+# returns None when the API is down, so the caller can fall back to on-chain prices.
+# After a failed request, the caller thread doesn't try again for retry_time seconds.
+class PriceFeed:
+    def __init__(self, url = 'https://exchange-rate.skymavis.com/', ttl = 5*60, max_stale = 60*60, timeout = 5,
+                 retry_time = 60):
+        self.url = url
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.timeout = timeout
+        self.retry_time = retry_time
+
+        self._lock = Lock()
+        self._prices = None
+        self._updated = 0
+        self._refreshing = False
+        self._failed = 0
+
+    def _fetch(self):
+        # revalidated with the server validators, if any, so unchanged prices cost no body
+        prices = http_client.client.get_json(self.url, timeout = self.timeout)
+        with self._lock:
+            self._prices = prices
+            self._updated = time()
+        return prices
+
+    def _refresh_in_background(self):
+        try:
+            self._fetch()
+        except Exception:
+            pass # keep serving the stale prices
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get(self):
+        with self._lock:
+            age = time() - self._updated
+            prices = self._prices
+
+            if prices is not None and age < self.ttl:
+                return prices
+
+            if prices is not None and age < self.max_stale:
+                if not self._refreshing:
+                    self._refreshing = True
+                    Thread(target = self._refresh_in_background, daemon = True).start()
+                return prices
+
+            if time() - self._failed < self.retry_time:
+                return None
+
+        try:
+            return self._fetch()
+        except Exception:
+            with self._lock:
+                self._failed = time()
+            return None
+
+    # usd prices of the tokens (None if not available), from a single get()
+    def get_prices(self, symbols):
+        prices = self.get()
+        return [None if prices is None or symbol.lower() not in prices else prices[symbol.lower()]['usd']
+                for symbol in symbols]
+
+    def get_price(self, symbol):
+        return self.get_prices([symbol])[0]
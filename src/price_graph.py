@@ -0,0 +1,80 @@
+from threading import Lock
+from web3 import Web3
+import heapq
+import contract_registry
+
+# Prices of all the tokens of a set of Katana pairs, in units of a quote token (e.g. USDC).
+#
+# The topology (token0, token1, symbols and decimals) never changes, so it is read
+# once. The reserves of the pairs are read by the caller (see get_reserves_calls), so
+# they can go in the multicall it already makes, and pricing every token costs nothing
+# more.
+#
+# Each token is priced through its most liquid path to the quote token: starting from
+# the quote token, the most liquid pair linking a priced token to an unpriced one is
+# taken first (a maximum spanning tree, as in Prim's algorithm), with the liquidity
+# valued in quote units. Tokens not connected to the quote token are left out.
+class PriceGraph:
+    def __init__(self, multicall2, pair_addrs, quote_token_addr):
+        self.multicall2 = multicall2
+        self.pairs = [contract_registry.get_contract(multicall2.eth, Web3.to_checksum_address(addr), 'katana_pair_abi.json')
+                      for addr in pair_addrs]
+        self.quote_token_addr = Web3.to_checksum_address(quote_token_addr)
+
+        self._lock = Lock()
+        self._tokens = None   # token address -> (symbol, decimals)
+        self._edges = None    # [(token0, token1)], one per pair
+
+    def _load_topology(self):
+        _, r = self.multicall2.aggregate([pair.functions.token0() for pair in self.pairs] +
+                                         [pair.functions.token1() for pair in self.pairs]).call()
+        n_pairs = len(self.pairs)
+        self._edges = [(Web3.to_checksum_address(token0), Web3.to_checksum_address(token1))
+                       for token0, token1 in zip(r[:n_pairs], r[n_pairs:])]
+
+        addrs = sorted(set([addr for edge in self._edges for addr in edge]))
+        # only to call decimals() and symbol(). WRON contract will be enough.
+        tokens = [contract_registry.get_contract(self.multicall2.eth, addr, 'wron_abi.json') for addr in addrs]
+        _, r = self.multicall2.aggregate([token.functions.symbol() for token in tokens] +
+                                         [token.functions.decimals() for token in tokens]).call()
+        self._tokens = {addr: (symbol, decimals) for addr, symbol, decimals in zip(addrs, r[:len(addrs)], r[len(addrs):])}
+
+    def get_reserves_calls(self):
+        return [pair.functions.getReserves() for pair in self.pairs]
+
+    # prices by token symbol, from the results of get_reserves_calls
+    def get_prices_by_symbol(self, reserves):
+        with self._lock:
+            if self._tokens is None:
+                self._load_topology()
+        return {self._tokens[addr][0]: price for addr, price in self._compute_prices(reserves).items()}
+
+    def _compute_prices(self, reserves):
+        # amounts in token units, per edge and direction
+        amounts = {}
+        for (token0, token1), (reserve0, reserve1, _) in zip(self._edges, reserves):
+            amount0 = reserve0*10**(-self._tokens[token0][1])
+            amount1 = reserve1*10**(-self._tokens[token1][1])
+            if amount0 == 0 or amount1 == 0:
+                continue
+            amounts.setdefault(token0, []).append((token1, amount0, amount1))
+            amounts.setdefault(token1, []).append((token0, amount1, amount0))
+
+        prices = {self.quote_token_addr: 1}
+        heap = []
+
+        def push_edges(token):
+            for other, amount, other_amount in amounts.get(token, []):
+                if other not in prices:
+                    liquidity = amount*prices[token]
+                    heapq.heappush(heap, (-liquidity, other, liquidity/other_amount))
+
+        push_edges(self.quote_token_addr)
+        while len(heap) > 0:
+            _, token, price = heapq.heappop(heap)
+            if token in prices:
+                continue
+            prices[token] = price
+            push_edges(token)
+
+        return prices
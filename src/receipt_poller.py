@@ -0,0 +1,129 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Thread
+from time import time
+from web3.exceptions import TransactionNotFound
+
+# Receipts of the transactions sent by all the restakers in the process, watched by a
+# single background thread.
+#
+# Instead of polling each hash with a backoff, the thread follows the block heads and
+# reads the transaction hashes of each new block, so the cost per block doesn't depend
+# on how many transactions are outstanding, and a receipt is fetched only for the
+# hashes found in a block. A hash is also checked once directly when it starts being
+# watched, in case it was mined before. Each watched hash gets a Future, resolved with
+# the receipt or failed after its timeout. The requests of a poll are issued at once,
+# so a batching provider sends them together.
+class ReceiptPoller:
+    def __init__(self, eth, interval = 1, timeout = 60*60, max_workers = 8):
+        self.eth = eth
+        self.interval = interval
+        self.timeout = timeout
+        self.max_workers = max_workers
+
+        self._cond = Condition()
+        self._pending = {} # txn hash -> (future, deadline)
+        self._new = [] # hashes not checked yet
+        self._last_block = None
+        self._thread = None
+
+    def watch(self, txn_hash, timeout = None, callback = None):
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        timeout = self.timeout if timeout is None else timeout
+        with self._cond:
+            self._pending[bytes(txn_hash)] = (future, time() + timeout)
+            self._new.append(bytes(txn_hash))
+            if self._thread is None:
+                self._thread = Thread(target = self._run, daemon = True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def wait(self, txn_hash, timeout = None):
+        return self.watch(txn_hash, timeout).result()
+
+    def _get_receipt(self, txn_hash):
+        try:
+            return self.eth.get_transaction_receipt(txn_hash), None
+        except Exception as e:
+            return None, e
+
+    # returns the hashes that could not be checked (request failed)
+    def _resolve(self, txn_hashes):
+        if len(txn_hashes) == 0:
+            return []
+        # requested at once, so a batching provider sends them together
+        with ThreadPoolExecutor(max_workers = min(self.max_workers, len(txn_hashes))) as executor:
+            results = list(executor.map(self._get_receipt, txn_hashes))
+
+        failed = []
+        for txn_hash, (receipt, error) in zip(txn_hashes, results):
+            if isinstance(error, TransactionNotFound):
+                continue # not mined (or not indexed) yet
+            if error is not None:
+                failed.append(txn_hash)
+                continue
+            with self._cond:
+                future, _ = self._pending.pop(txn_hash, (None, None))
+            if future is not None:
+                future.set_result(receipt)
+        return failed
+
+    def _expire(self):
+        now = time()
+        with self._cond:
+            expired = [txn_hash for txn_hash, (_, deadline) in self._pending.items() if deadline <= now]
+            futures = [self._pending.pop(txn_hash)[0] for txn_hash in expired]
+        for txn_hash, future in zip(expired, futures):
+            future.set_exception(Exception('can not get transaction receipt of 0x{}'.format(txn_hash.hex())))
+
+    def _poll(self):
+        # the head is read before checking the new hashes, so a hash mined after the check
+        # is in a block after the head, found by the next polls
+        block_number = self.eth.block_number
+
+        with self._cond:
+            new = self._new
+            self._new = []
+        failed = self._resolve(new)
+        with self._cond:
+            self._new += failed
+
+        # the first poll scans the head too: a hash mined in it may not be found by the
+        # direct check, if its receipt was not indexed yet
+        if self._last_block is None:
+            self._last_block = block_number - 1
+
+        # hashes of the blocks mined since the last poll
+        numbers = range(self._last_block + 1, block_number + 1)
+        included = set()
+        if len(numbers) > 0:
+            with ThreadPoolExecutor(max_workers = min(self.max_workers, len(numbers))) as executor:
+                for block in executor.map(self.eth.get_block, numbers):
+                    included.update([bytes(txn_hash) for txn_hash in block['transactions']])
+        self._last_block = block_number
+
+        with self._cond:
+            mined = [txn_hash for txn_hash in self._pending if txn_hash in included]
+        self._resolve(mined)
+        # failed requests, or receipts not indexed yet, are checked again in the next poll
+        with self._cond:
+            self._new += [txn_hash for txn_hash in mined if txn_hash in self._pending]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._pending) == 0:
+                    self._last_block = None # restart from the head when there's something to watch
+                    self._cond.wait()
+
+            try:
+                self._poll()
+            except Exception:
+                pass # try again in the next poll
+            self._expire()
+
+            with self._cond:
+                self._cond.wait(self.interval)
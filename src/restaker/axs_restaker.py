@@ -1,5 +1,4 @@
 from web3 import Web3
-import utils
 from .restaker import Restaker
 
 class AXSRestaker(Restaker):
@@ -11,9 +10,16 @@ class AXSRestaker(Restaker):
     @classmethod
     def _is_staking_token_lp_token(cls):
         return False
-    
-    def _estimate_gas_to_restake(self, N=10):
-        gas_estimated = utils.estimate_gas_used(self.staking_pool.functions.restakeRewards, N = N)
+
+    def _get_restake_functions(self):
+        return [self.staking_pool.functions.restakeRewards]
+
+    def _get_restake_events(self):
+        return [(self.staking_pool.address, 'Staked')]
+
+    def _estimate_gas_to_restake(self, N=10, q=0.5):
+        gas_estimated = self._gas_cache.estimate_gas_used(self.staking_pool.functions.restakeRewards, N = N, q = q,
+                                                          scan = self._scan_restake_txns)
         return gas_estimated
 
     def restake_rewards(self):
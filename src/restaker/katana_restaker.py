@@ -1,29 +1,61 @@
-import utils
 from time import time
+from collections import namedtuple
 from .restaker import Restaker
+from twap_sampler import TwapSampler
+import amm
 
 class KatanaRestaker(Restaker):
+
+    # TWAP samplers shared by the restakers of the same pair, polled by whatever runs the
+    # strategies (see Strategy.run and Supervisor)
+    _twap_samplers = {}
+
+    # max deviation of the spot price from the TWAP to accept a swap
+    _twap_window = 30*60 # 30 minutes
+    _max_twap_deviation = 0.03
    
     def __init__(self, priv_key, staking_pool_addr):
         super().__init__(priv_key, staking_pool_addr) 
 
+        if self.staking_token.address not in KatanaRestaker._twap_samplers:
+            KatanaRestaker._twap_samplers[self.staking_token.address] = TwapSampler(self.multicall2, self.staking_token)
+        self.twap_sampler = KatanaRestaker._twap_samplers[self.staking_token.address]
+
     @classmethod
     def _is_staking_token_lp_token(cls):
         return True
-    
-    def _estimate_gas_to_restake(self, N=10):
-        gas_estimated = utils.estimate_gas_used(self.staking_pool.functions.claimPendingRewards, N = N)
-        gas_estimated += utils.estimate_gas_used(self.permissioned_router.functions.swapExactRONForTokens, N = N)  
-        gas_estimated += utils.estimate_gas_used(self.permissioned_router.functions.addLiquidityRON, N = N)
-        gas_estimated += utils.estimate_gas_used(self.staking_pool.functions.stake, N = N)
+
+    def _get_restake_functions(self):
+        return [self.staking_pool.functions.claimPendingRewards,
+                self.permissioned_router.functions.swapExactRONForTokens,
+                self.permissioned_router.functions.addLiquidityRON,
+                self.staking_pool.functions.stake]
+
+    def _get_restake_events(self):
+        return [(self.staking_pool.address, 'RewardClaimed'),
+                (self.staking_token.address, 'Swap'),
+                (self.staking_token.address, 'Mint'),
+                (self.staking_pool.address, 'Staked')]
+
+    def _estimate_gas_to_restake(self, N=10, q=0.5):
+        gas_estimated = sum(self._gas_cache.estimate_gas_used_many(self._get_restake_functions(), N = N, q = q,
+                                                                   scan = self._scan_restake_txns))
         return gas_estimated
 
-    def claim_rewards(self):
-        claim_call = self.staking_pool.functions.claimPendingRewards()
+    # explicit gas limits of the claim, swap, add liquidity and stake transactions, from a
+    # high quantile of the gas used history plus the buffer added to the node estimates.
+    # Needed to send transactions that depend on others not mined yet.
+    def _get_restake_gas_limits(self, N=10, q=0.9):
+        return [gas + 100000 for gas in self._gas_cache.estimate_gas_used_many(self._get_restake_functions(), N = N, q = q,
+                                                                               scan = self._scan_restake_txns)]
 
-        claim_txn_hash = self._send_signed_transaction(claim_call)
-        claim_txn_rec = self._wait_txn_receipt(claim_txn_hash)
+    def _get_other_token(self):
+        return self.token0 if self.reward_token.address == self.token1.address else self.token1
 
+    def send_claim_rewards(self, params = {}):
+        return self._send_signed_transaction(self.staking_pool.functions.claimPendingRewards(), params)
+
+    def get_claim_result(self, claim_txn_rec):
         gas_used = claim_txn_rec['gasUsed'] # TODO: printar
 
         if claim_txn_rec['status'] == 0:
@@ -34,61 +66,91 @@ class KatanaRestaker(Restaker):
 
         return claimed_reward, gas_used
 
-    def swap_ron_for_token(self, ron_to_swap):
-        if self.reward_token.address == self.token1.address:
-            token = self.token0
-            token_price = self._get_token0_price_from_lp()
+    def claim_rewards(self):
+        claim_txn_hash = self.send_claim_rewards()
+        return self.get_claim_result(self._wait_txn_receipt(claim_txn_hash))
+
+    # (WRON reserve, other token reserve, LP total supply), read in one multicall
+    def get_pair_snapshot(self):
+        _, [reserves, total_supply] = self.multicall2.aggregate([self.staking_token.functions.getReserves(),
+                                                                 self.staking_token.functions.totalSupply()]).call()
+        return self._make_pair_snapshot(reserves, total_supply)
+
+    # pair snapshot from a record with the fields of _get_price_calls (e.g. a chain snapshot)
+    def get_pair_snapshot_from(self, info):
+        return self._make_pair_snapshot(info.staking_token_reserves, info.staking_token_total_supply)
+
+    def _make_pair_snapshot(self, reserves, total_supply):
+        if self.reward_token.address == self.token0.address:
+            return KatanaRestaker.PairSnapshot(reserves[0], reserves[1], total_supply)
         else:
-            token = self.token1
-            token_price = self._get_token1_price_from_lp()
-
-        slippage = 0.01
+            return KatanaRestaker.PairSnapshot(reserves[1], reserves[0], total_supply)
+
+    PairSnapshot = namedtuple('PairSnapshot', ['ron_reserve', 'token_reserve', 'total_supply'])
+    RestakeSizing = namedtuple('RestakeSizing', ['ron_to_swap', 'token_amount', 'ron_to_add', 'token_to_add', 'liquidity'])
+
+    # sizing of the whole restake of ron_amount (swap and add liquidity) from a single snapshot
+    def size_restake(self, ron_amount, snapshot = None):
+        if snapshot is None:
+            snapshot = self.get_pair_snapshot()
+        return KatanaRestaker.RestakeSizing(*amm.size_single_sided_deposit(ron_amount,
+                                                                           snapshot.ron_reserve,
+                                                                           snapshot.token_reserve,
+                                                                           snapshot.total_supply))
+
+    # min_token_amount: min output accepted
+    def send_swap_ron_for_token(self, ron_to_swap, min_token_amount, params = {}):
         deadline = 30*60 # 30 minutes
 
-        token_amount = round(ron_to_swap/token_price)*(1-0.003) # 0.3% swap fee
-
-        swap_call = self.permissioned_router.functions.swapExactRONForTokens(round((1-slippage)*token_amount), 
-                                                                [self.reward_token.address, token.address], 
-                                                                self.wallet.address, 
+        swap_call = self.permissioned_router.functions.swapExactRONForTokens(min_token_amount,
+                                                                [self.reward_token.address, self._get_other_token().address],
+                                                                self.wallet.address,
                                                                 round(time()+deadline))
-        swap_params = {'value': ron_to_swap}
+        swap_params = dict(params)
+        swap_params['value'] = ron_to_swap
 
-        swap_txn_hash = self._send_signed_transaction(swap_call, swap_params)
-        swap_txn_rec = self._wait_txn_receipt(swap_txn_hash)
+        return self._send_signed_transaction(swap_call, swap_params)
 
+    def get_swap_result(self, swap_txn_rec):
         gas_used = swap_txn_rec['gasUsed'] # TODO: printar
 
         if swap_txn_rec['status'] == 0:
             raise Exception('swap failed')
         
         log = Restaker._get_log_from_receipt(swap_txn_rec, self.staking_token.events.Swap())
-        key = '_amount{}Out'.format('0' if token.address == self.token0.address else '1')
+        key = '_amount{}Out'.format('0' if self._get_other_token().address == self.token0.address else '1')
         swapped_amount = log.args[key]
 
         return swapped_amount, gas_used
 
-    def add_liquidity(self, token_amount):
-        if self.reward_token.address == self.token1.address:
-            token = self.token0
-            ron_amount = round(self._get_token0_price_from_lp()*token_amount)
-        else:
-            token = self.token1
-            ron_amount = round(self._get_token1_price_from_lp()*token_amount)
+    # token_amount: expected output. If not given, it is quoted from the current reserves.
+    def swap_ron_for_token(self, ron_to_swap, token_amount = None):
+        slippage = 0.01
+
+        if token_amount is None:
+            snapshot = self.get_pair_snapshot()
+            token_amount = amm.get_amount_out(ron_to_swap, snapshot.ron_reserve, snapshot.token_reserve)
+
+        swap_txn_hash = self.send_swap_ron_for_token(ron_to_swap, round((1-slippage)*token_amount))
+        return self.get_swap_result(self._wait_txn_receipt(swap_txn_hash))
 
+    # deposits token_amount (at least min_token_amount) with about ron_amount
+    def send_add_liquidity(self, token_amount, min_token_amount, ron_amount, params = {}):
         deadline = 30*60 # 30 minutes
         slippage = 0.01
 
-        liquidity_call = self.permissioned_router.functions.addLiquidityRON(token.address,
-                                                                    token_amount,
+        liquidity_call = self.permissioned_router.functions.addLiquidityRON(self._get_other_token().address,
                                                                     token_amount,
+                                                                    min_token_amount,
                                                                     round(ron_amount*(1-slippage)),
                                                                     self.wallet.address,
                                                                     round(time()+deadline))
-        liquidity_params = {'value': round(ron_amount*(1+slippage))}
+        liquidity_params = dict(params)
+        liquidity_params['value'] = round(ron_amount*(1+slippage))
 
-        liquidity_txn_hash = self._send_signed_transaction(liquidity_call, liquidity_params)
-        liquidity_txn_rec = self._wait_txn_receipt(liquidity_txn_hash)
+        return self._send_signed_transaction(liquidity_call, liquidity_params)
 
+    def get_add_liquidity_result(self, liquidity_txn_rec):
         gas_used = liquidity_txn_rec['gasUsed'] # TODO: printar
 
         if liquidity_txn_rec['status'] == 0:
@@ -99,12 +161,18 @@ class KatanaRestaker(Restaker):
 
         return minted_amount, gas_used
 
-    def stake(self, amount_to_stake):
-        stake_call = self.staking_pool.functions.stake(amount_to_stake)
+    def add_liquidity(self, token_amount):
+        # the swap already happened, so the current reserves give the deposit ratio
+        snapshot = self.get_pair_snapshot()
+        ron_amount = amm.quote(token_amount, snapshot.token_reserve, snapshot.ron_reserve)
+
+        liquidity_txn_hash = self.send_add_liquidity(token_amount, token_amount, ron_amount)
+        return self.get_add_liquidity_result(self._wait_txn_receipt(liquidity_txn_hash))
 
-        stake_txn_hash = self._send_signed_transaction(stake_call)
-        stake_txn_rec = self._wait_txn_receipt(stake_txn_hash)
+    def send_stake(self, amount_to_stake, params = {}):
+        return self._send_signed_transaction(self.staking_pool.functions.stake(amount_to_stake), params)
 
+    def get_stake_result(self, stake_txn_rec):
         gas_used = stake_txn_rec['gasUsed'] # TODO: printar
 
         if stake_txn_rec['status'] == 0:
@@ -112,30 +180,88 @@ class KatanaRestaker(Restaker):
         
         return gas_used
 
-    def _get_token0_price_from_lp(self, N = 20):
-        return self._get_token_price_from_lp(0, N = N)
+    def stake(self, amount_to_stake):
+        stake_txn_hash = self.send_stake(amount_to_stake)
+        return self.get_stake_result(self._wait_txn_receipt(stake_txn_hash))
+
+    RestakeState = namedtuple('RestakeState', ['pending_rewards', 'ron_balance', 'snapshot'])
+
+    # pending rewards, RON balance and pair snapshot, read in one multicall
+    def get_restake_state(self):
+        _, [pending_rewards, ron_balance, reserves, total_supply] = self.multicall2.aggregate([
+                self.staking_pool.functions.getPendingRewards(self.wallet.address),
+                self.multicall2.contract.functions.getRonBalance(self.wallet.address),
+                self.staking_token.functions.getReserves(),
+                self.staking_token.functions.totalSupply()]).call()
+        return KatanaRestaker.RestakeState(pending_rewards, ron_balance, self._make_pair_snapshot(reserves, total_supply))
+
+    # Sends the claim, swap and add liquidity of a restake back-to-back, with consecutive
+    # nonces and explicit gas limits, so they are usually mined in the same block. The
+    # outputs are simulated locally from the sizing snapshot: the liquidity deposit uses
+    # the min swap output, so it never needs more tokens than the swap gives (the
+    # difference, if any, is left in the wallet). Returns the three txn hashes, in order.
+    def send_pipelined_restake(self, sizing, snapshot, gas_limits, gas_price):
+        slippage = 0.01
 
-    def _get_token1_price_from_lp(self, N = 20):
-        return self._get_token_price_from_lp(1, N = N)
-    
-    def _get_token_price_from_lp(self, idx, N = 20):
-        func = self.staking_token.get_function_by_name('price{}CumulativeLast'.format(idx))
-
-        block_number, [reserves, price_t1] = self.multicall2.aggregate([
-            self.staking_token.functions.getReserves(),
-            func()
-        ]).call()
-
-        price_t0 = func().call(block_identifier = block_number - N)  
-
-        # if cumulative price changed, calculate TWAP
-        # else, use reserves ratio
-        # TODO: TWAP price too high. Debug
-        if False: # price_t1-price_t0 != 0:
-            t1 = self.ronin_chain.eth.get_block(block_number)['timestamp']
-            t0 = self.ronin_chain.eth.get_block(block_number - N)['timestamp']
-            price = (price_t1 - price_t0)/(t1 - t0)
-        else:
-            price = reserves[1-idx]/reserves[idx]
+        min_token_amount, ron_amount = self._get_pipelined_amounts(sizing, snapshot)
 
-        return price
\ No newline at end of file
+        # the claim does not depend on the other transactions, so it can be simulated on the node
+        self.staking_pool.functions.claimPendingRewards().call({'from': self.wallet.address})
+
+        # consecutive nonces, with no other process using the wallet in between
+        with self._transaction_burst():
+            claim_txn_hash = self.send_claim_rewards({'gas': gas_limits[0], 'gasPrice': gas_price})
+            swap_txn_hash = self.send_swap_ron_for_token(sizing.ron_to_swap, min_token_amount,
+                                                         {'gas': gas_limits[1], 'gasPrice': gas_price})
+            liquidity_txn_hash = self.send_add_liquidity(min_token_amount, round((1-slippage)*min_token_amount), ron_amount,
+                                                         {'gas': gas_limits[2], 'gasPrice': gas_price})
+        return claim_txn_hash, swap_txn_hash, liquidity_txn_hash
+
+    # min swap output and RON of the liquidity deposit of a pipelined restake
+    def _get_pipelined_amounts(self, sizing, snapshot):
+        slippage = 0.01
+
+        min_token_amount = round((1-slippage)*sizing.token_amount)
+        # reserves after the swap give the deposit ratio
+        ron_amount = amm.quote(min_token_amount, snapshot.token_reserve - sizing.token_amount,
+                               snapshot.ron_reserve + sizing.ron_to_swap)
+        return min_token_amount, ron_amount
+
+    # RON the wallet needs after the claim to send the swap, add liquidity and stake of a
+    # pipelined restake: their values (the deposit sends 1% more RON than it expects to
+    # use, refunded by the router) plus their max fees
+    def get_pipelined_restake_cost(self, sizing, snapshot, gas_limits, gas_price):
+        slippage = 0.01
+
+        _, ron_amount = self._get_pipelined_amounts(sizing, snapshot)
+        return sizing.ron_to_swap + round(ron_amount*(1+slippage)) + sum(gas_limits[1:])*gas_price
+
+    # relative deviation of the spot price of the pair snapshot from the TWAP, to refuse
+    # to swap on manipulated reserves (e.g. in the same block). It's 0 while the samples
+    # don't cover half of the window. To be checked before claiming, so a deviation
+    # postpones the whole restake instead of leaving the claimed rewards idle.
+    def get_spot_price_deviation(self, snapshot = None):
+        if snapshot is None:
+            snapshot = self.get_pair_snapshot()
+        idx = 0 if self.reward_token.address == self.token1.address else 1
+        if self.twap_sampler.get_coverage() < self._twap_window/2:
+            return 0
+        twap = self.twap_sampler.get_twap(idx, self._twap_window)
+        spot = snapshot.ron_reserve/snapshot.token_reserve
+        return spot/twap - 1
+
+    def _get_token0_price_from_lp(self, window = None):
+        return self._get_token_price_from_lp(0, window = window)
+
+    def _get_token1_price_from_lp(self, window = None):
+        return self._get_token_price_from_lp(1, window = window)
+    
+    # price of token idx in units of the other token. The TWAP comes from the in-memory
+    # samples. While they don't cover half of the window, the reserves ratio is used.
+    def _get_token_price_from_lp(self, idx, window = None):
+        window = self._twap_window if window is None else window
+        if self.twap_sampler.get_coverage() >= window/2:
+            return self.twap_sampler.get_twap(idx, window)
+
+        _, [reserves] = self.multicall2.aggregate([self.staking_token.functions.getReserves()]).call()
+        return reserves[1-idx]/reserves[idx]
@@ -1,39 +1,103 @@
 from web3 import Web3
 from web3.middleware import geth_poa_middleware
-from time import sleep
 import utils
 from multicall2 import Multicall2
-import requests
+from gas_cache import GasUsageCache
+from gain_rate_tracker import GainRateTracker
+from block_index import BlockTimestampIndex
+from price_feed import PriceFeed
+from price_graph import PriceGraph
+from nonce_manager import NonceManager
+from receipt_poller import ReceiptPoller
+from batch_provider import BatchHTTPProvider
+from rpc_pool import RpcPoolProvider
+from event_indexer import EventIndexer
+import contract_registry
 import os
 from filelock import FileLock
+from contextlib import contextmanager
 
 class Restaker:
     _headers ={'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:95.0) Gecko/20100101 Firefox/95.0',
               'content-type': 'application/json'}
 
-    _ronin_rpc = 'https://api.roninchain.com/rpc'
+    # endpoints of the RPC pool. Reads go to the fastest healthy one, transactions to all.
+    _ronin_rpcs = ['https://api.roninchain.com/rpc']
     _multicall2_addr = Web3.to_checksum_address('0xc76d0d0d3aa608190f78db02bf2f5aef374fc0b9')
     _staking_manager_addr = Web3.to_checksum_address('0x8bd81a19420bad681b7bfc20e703ebd8e253782d')
     _wron_token_addr = Web3.to_checksum_address('0xe514d9deb7966c8be0ca922de8a064264ea6bcd4')
     _permissioned_router_addr = Web3.to_checksum_address('0xc05afc8c9353c1dd5f872eccfacd60fd5a2a9ac7')
 
+    # usd prices shared by all restakers in the process
+    _price_feed = PriceFeed()
+
+    # Katana pairs used to price the tokens from the liquidity pools, in USDC
+    _usdc_token_addr = Web3.to_checksum_address('0x0b7007c13325c48911f73a2dad5fa5dcbf808adc')
+    _katana_pairs_addr = [Web3.to_checksum_address('0x4f7687affc10857fccd0938ecda0947de7ad3812'), # WRON-USDC
+                          Web3.to_checksum_address('0x32d1dbb6a4275133cc49f1c61653be3998ada4ff'), # WRON-AXS
+                          Web3.to_checksum_address('0x2ecb08f87f075b5769fe543d0e52e40140575ea7'), # WRON-WETH
+                          Web3.to_checksum_address('0x8f1c5eda143fa3d1bea8b4e92f33562014d30e0d'), # WRON-SLP
+                          Web3.to_checksum_address('0xa7964991f339668107e2b6a6f6b8e8b74aa9d017'), # USDC-WETH
+                          Web3.to_checksum_address('0x306a28279d04a47468ed83d55088d0dcd1369294'), # SLP-WETH
+                          Web3.to_checksum_address('0xc6344bc1604fcab1a5aad712d766796e2b7a70b9')] # AXS-WETH
+    _price_graphs = {}
+
     def __init__(self, priv_key, staking_pool_addr):
+        self._prices_plan = None
+        self._sent_calls = {} # txn hash -> call, to feed the gas cache with our own receipts
+        self._in_burst = False
         self._create_chains()
         self._create_wallet(priv_key)
         self._create_contracts(staking_pool_addr)
         self._get_tokens_decimals_and_symbols()
+        self._create_price_graph()
+        self._create_event_indexer()
+        self.gain_rate_tracker = GainRateTracker(self)
+        if Restaker._gas_cache is None:
+            Restaker._gas_cache = GasUsageCache()
     
+    # gas used by the restaking functions, shared by all restakers in the process.
+    # Created with the first restaker, so importing the module doesn't read the file.
+    _gas_cache = None
+
+    # chains are shared by all restakers in the process, so many restakers
+    # hosted together don't hold their own web3 stack and connections
+    _chains = {}
+
+    _block_indexes = {}
+
+    _receipt_pollers = {}
+
     def _create_chains(self):
-        self.ronin_chain = Restaker._create_chain(Restaker._ronin_rpc)
+        self._chain_key = tuple(Restaker._ronin_rpcs)
+        if self._chain_key not in Restaker._chains:
+            Restaker._chains[self._chain_key] = Restaker._create_chain(Restaker._ronin_rpcs)
+            Restaker._block_indexes[self._chain_key] = BlockTimestampIndex(Restaker._chains[self._chain_key].eth)
+            Restaker._receipt_pollers[self._chain_key] = ReceiptPoller(Restaker._chains[self._chain_key].eth)
+        self.ronin_chain = Restaker._chains[self._chain_key]
+        self.block_index = Restaker._block_indexes[self._chain_key]
+        self.receipt_poller = Restaker._receipt_pollers[self._chain_key]
 
     @staticmethod
-    def _create_chain(rpc):
-        chain = Web3(Web3.HTTPProvider(rpc, request_kwargs = {'headers':Restaker._headers}))
+    def _create_chain(rpcs):
+        # reads issued together by many restakers are sent as JSON-RPC batches
+        if len(rpcs) == 1:
+            provider = BatchHTTPProvider(rpcs[0], request_kwargs = {'headers':Restaker._headers})
+        else:
+            provider = RpcPoolProvider(rpcs, request_kwargs = {'headers':Restaker._headers})
+        chain = Web3(provider)
         chain.middleware_onion.inject(geth_poa_middleware, layer=0)
         return chain
     
+    # nonces of each wallet, shared by its restakers in the process
+    _nonce_managers = {}
+
     def _create_wallet(self, priv_key):
         self.wallet = self.ronin_chain.eth.account.from_key(priv_key)
+        key = (self._chain_key, self.wallet.address)
+        if key not in Restaker._nonce_managers:
+            Restaker._nonce_managers[key] = NonceManager(self.ronin_chain.eth, self.wallet.address)
+        self.nonce_manager = Restaker._nonce_managers[key]
 
     def _create_contracts(self, staking_pool_addr):
         self.multicall2 = Multicall2(self.ronin_chain.eth, Restaker._multicall2_addr)
@@ -67,14 +131,19 @@ class Restaker:
             assert reward_token_addr == Restaker._wron_token_addr, 'Reward token is not WRON!'
             assert Restaker._wron_token_addr == token0_addr or Restaker._wron_token_addr == token1_addr, 'WRON is not in the token pair!'    
 
-    def _create_contract(self, address, abi_file = None):
-        if abi_file is None:
-            abi = utils.get_contract_abi(address)
-        else:
-            with open(os.path.join(os.path.dirname(__file__), '..', 'abi', abi_file)) as f:
-                abi = f.read()
+    # event indexers of the staking pools, shared by their restakers in the process
+    _event_indexers = {}
 
-        return self.ronin_chain.eth.contract(address = address, abi = abi)
+    def _create_event_indexer(self):
+        key = (self._chain_key, self.staking_pool.address)
+        if key not in Restaker._event_indexers:
+            event_indexer = EventIndexer(self.ronin_chain.eth, self.block_index, name = self.staking_pool.address)
+            event_indexer.add_restaker(self)
+            Restaker._event_indexers[key] = event_indexer
+        self.event_indexer = Restaker._event_indexers[key]
+
+    def _create_contract(self, address, abi_file = None):
+        return contract_registry.get_contract(self.ronin_chain.eth, address, abi_file)
 
     @classmethod
     def _is_staking_token_lp_token(cls):
@@ -95,132 +164,126 @@ class Restaker:
                                        staking_token.functions.decimals(),
                                        reward_token.functions.symbol(),
                                        reward_token.functions.decimals(),
-                                       self.wron_token.functions.decimals()]).call()
+                                       self.wron_token.functions.decimals(),
+                                       self.wron_token.functions.symbol()]).call()
         self.staking_token_symbol = r[1][0]
         self.staking_token_decimals = r[1][1]
         self.reward_token_symbol = r[1][2]
         self.reward_token_decimals = r[1][3]
         self.wron_token_decimals = r[1][4]
+        self.wron_token_symbol = r[1][5]
 
-    def _get_tokens_prices_usd_from_liquidity_pools(self):
-        wron_usdc_lp_staking_pool_addr = Web3.to_checksum_address('0xba1c32baff8f23252259a641fd5ca0bd211d4f65')
-        wron_axs_lp_staking_pool_addr = Web3.to_checksum_address('0x14327fa6a4027d8f08c0a1b7feddd178156e9527')
-        wron_weth_lp_staking_pool_addr = Web3.to_checksum_address('0xb9072cec557528f81dd25dc474d4d69564956e1e')
-        wron_slp_lp_staking_pool_addr = Web3.to_checksum_address('0x4e2d6466a53444248272b913c105e9281ec266d8')
+        if self._is_staking_token_lp_token():
+            r = self.multicall2.aggregate([self.token0.functions.symbol(),
+                                           self.token0.functions.decimals(),
+                                           self.token1.functions.symbol(),
+                                           self.token1.functions.decimals()]).call()
+            self.token0_symbol = r[1][0]
+            self.token0_decimals = r[1][1]
+            self.token1_symbol = r[1][2]
+            self.token1_decimals = r[1][3]
+
+    # Katana pair graph used to price the tokens on-chain when the exchange rate API is
+    # not available, shared by the restakers of the chain. The reserves of its pairs are
+    # read in the multicall of the LP token reserves (see _get_price_calls), so the
+    # fallback costs no extra request.
+    def _create_price_graph(self):
+        if self._chain_key not in Restaker._price_graphs:
+            Restaker._price_graphs[self._chain_key] = PriceGraph(self.multicall2, Restaker._katana_pairs_addr, Restaker._usdc_token_addr)
+        self.price_graph = Restaker._price_graphs[self._chain_key]
+
+    # calls needed to price the tokens, run as one multicall plan or in the chain snapshot
+    def _get_price_calls(self):
+        calls = {'price_graph_reserves_{}'.format(i): call for i, call in enumerate(self.price_graph.get_reserves_calls())}
+        if self._is_staking_token_lp_token():
+            calls['staking_token_total_supply'] = self.staking_token.functions.totalSupply()
+            calls['staking_token_reserves'] = self.staking_token.functions.getReserves()
+        return calls
+
+    def _get_prices_plan(self):
+        if self._prices_plan is None:
+            self._prices_plan = self.multicall2.plan('PricesInfo', **self._get_price_calls())
+        return self._prices_plan
+
+    # usd price of each token, from the exchange rate API or, if it is not
+    # available, from the on-chain reserves
+    def _get_tokens_prices(self, info):
+        if self._is_staking_token_lp_token():
+            symbols = [self.token0_symbol, self.token1_symbol]
+        else:
+            symbols = [self.staking_token_symbol]
+        symbols += [self.reward_token_symbol, self.wron_token_symbol]
 
-        staking_pools_addr = [wron_usdc_lp_staking_pool_addr, 
-                              wron_axs_lp_staking_pool_addr, 
-                              wron_weth_lp_staking_pool_addr,
-                              wron_slp_lp_staking_pool_addr]
+        prices = Restaker._price_feed.get_prices(symbols)
+        if all([price is not None for price in prices]):
+            return dict(zip(symbols, prices))
 
-        staking_pools = [self._create_contract(addr, 'erc20_staking_pool_abi.json') for addr in staking_pools_addr]
+        # USDC is assumed to be worth 1 USD
+        reserves = [getattr(info, 'price_graph_reserves_{}'.format(i)) for i in range(len(self.price_graph.pairs))]
+        prices = self.price_graph.get_prices_by_symbol(reserves)
+        return {symbol: prices[symbol] for symbol in symbols}
 
-        r = self.multicall2.aggregate([staking_pool.functions.getStakingToken() for staking_pool in staking_pools]).call()
-        lp_tokens = [self._create_contract(Web3.to_checksum_address(addr), 'katana_pair_abi.json') for addr in r[1]]
+    # info: record with the fields of _get_price_calls, e.g. the chain snapshot state.
+    # If not given, the price calls are executed alone.
+    def _get_tokens_prices_usd(self, info = None):
+        if info is None:
+            info = self._get_prices_plan().execute()
+
+        prices = self._get_tokens_prices(info)
 
-        r = self.multicall2.aggregate([lp_token.functions.getReserves() for lp_token in lp_tokens] + 
-                                      [lp_token.functions.token0() for lp_token in lp_tokens] + 
-                                      [lp_token.functions.token1() for lp_token in lp_tokens]).call()
-        
-        n_tokens = len(lp_tokens)
-        reserves = r[1][:n_tokens]
-        token0_addr = r[1][n_tokens:2*n_tokens]
-        token1_addr = r[1][2*n_tokens:]
-
-        token0 = [self._create_contract(Web3.to_checksum_address(addr), 'wron_abi.json') for addr in token0_addr] 
-        token1 = [self._create_contract(Web3.to_checksum_address(addr), 'wron_abi.json') for addr in token1_addr]
-
-        r = self.multicall2.aggregate([token.functions.symbol() for token in token0 + token1] + 
-                                      [token.functions.decimals() for token in token0 + token1]).call()
-        token0_symbols = r[1][:n_tokens]
-        token1_symbols = r[1][n_tokens:2*n_tokens]
-        token0_decimals = r[1][2*n_tokens:3*n_tokens]
-        token1_decimals = r[1][3*n_tokens:]
-
-        reserves_dict = {}
-
-        for token0_sym, token1_sym, token0_dec, token1_dec, [token0_reserve, token1_reserve, _] in zip(token0_symbols, token1_symbols, token0_decimals, token1_decimals, reserves):
-            if token0_sym in reserves_dict and token1_sym in reserves_dict:
-                raise Exception("Both tokens are already in reserves dict.")
-            
-            if token0_sym in reserves_dict:
-                reserves_dict[token1_sym] = token1_reserve * 10**(-token1_dec) * reserves_dict[token0_sym]/(token0_reserve*10**(-token0_dec))
-            elif token1_sym in reserves_dict:
-                reserves_dict[token0_sym] = token0_reserve * 10**(-token0_dec) * reserves_dict[token1_sym]/(token1_reserve*10**(-token1_dec))
-            else:
-                reserves_dict[token0_sym] = token0_reserve * 10**(-token0_dec)
-                reserves_dict[token1_sym] = token1_reserve * 10**(-token1_dec)
-
-        prices_dict = {}
-        for key in reserves_dict:
-            prices_dict[key] = reserves_dict['USDC']/reserves_dict[key]
-
-        return prices_dict
-
-    def _get_tokens_prices_usd(self):
-        r = requests.get('https://exchange-rate.skymavis.com/')
-        r.raise_for_status()
-        r = r.json()
-    
         if self._is_staking_token_lp_token():
-            r_aux = self.multicall2.aggregate([self.reward_token.functions.symbol(),
-                                           self.wron_token.functions.symbol(),
-                                           self.token0.functions.symbol(),
-                                           self.token1.functions.symbol(),
-                                           self.staking_token.functions.totalSupply(),
-                                           self.staking_token.functions.getReserves(),
-                                           self.token0.functions.decimals(),
-                                           self.token1.functions.decimals()]).call()
-            
-            reward_token_symbol = r_aux[1][0]
-            wron_token_symbol = r_aux[1][1]
-            token0_symbol = r_aux[1][2]
-            token1_symbol = r_aux[1][3]
-            staking_token_total_supply = r_aux[1][4]
-            reserves0, reserves1 = r_aux[1][5][:2]
-            token0_decimals = r_aux[1][6]
-            token1_decimals = r_aux[1][7]
-
-            token0_price = r[token0_symbol.lower()]['usd'] 
-            token1_price = r[token1_symbol.lower()]['usd']
-            staking_token_price = (reserves0*token0_price*10**(-token0_decimals)
-                                    +reserves1*token1_price*10**(-token1_decimals))/(staking_token_total_supply*10**(-self.staking_token_decimals))
+            reserves0, reserves1 = info.staking_token_reserves[:2]
+            token0_price = prices[self.token0_symbol]
+            token1_price = prices[self.token1_symbol]
+            staking_token_price = (reserves0*token0_price*10**(-self.token0_decimals)
+                                    +reserves1*token1_price*10**(-self.token1_decimals))/(info.staking_token_total_supply*10**(-self.staking_token_decimals))
         else:
-            r_aux = self.multicall2.aggregate([self.reward_token.functions.symbol(),
-                                           self.wron_token.functions.symbol(),
-                                           self.staking_token.functions.symbol()]).call()
-            
-            reward_token_symbol = r_aux[1][0]
-            wron_token_symbol = r_aux[1][1]
-            staking_token_symbol = r_aux[1][2]
-
-            staking_token_price = r[staking_token_symbol.lower()]['usd']
+            staking_token_price = prices[self.staking_token_symbol]
 
-        wron_token_price = r[wron_token_symbol.lower()]['usd']
-        reward_token_price = r[reward_token_symbol.lower()]['usd']
+        wron_token_price = prices[self.wron_token_symbol]
+        reward_token_price = prices[self.reward_token_symbol]
 
         return staking_token_price, reward_token_price, wron_token_price
 
-    def _estimate_gas_to_restake(self):
+    def _estimate_gas_to_restake(self, N = 10, q = 0.5):
         raise NotImplementedError('not implemented')    
-        
-    def _get_gain_rate(self, reward_staking_price_ratio, N = 28800):
-        # block time is ~3 now, but it can change in the future.
-        # estimate gain rate using the last 28800 blocks (~1 day now)
-        to_block = self.ronin_chain.eth.block_number
-        from_block = to_block - N
 
-        t = self.ronin_chain.eth.get_block(to_block)['timestamp'] - self.ronin_chain.eth.get_block(from_block)['timestamp']
-
-        r = self.multicall2.aggregate([
-                self.staking_manager.functions.getIntervalRewards(self.staking_pool.address, from_block, to_block),
-                self.staking_pool.functions.getStakingTotal()]).call()
-        total_reward = r[1][0]*10**(-self.reward_token_decimals)
-        total_staking = r[1][1]*10**(-self.staking_token_decimals)
+    def _get_restake_functions(self):
+        raise NotImplementedError('not implemented')
+
+    # event (address, event name) emitted by each of the restake functions, to find their
+    # transactions in the event indexer
+    def _get_restake_events(self):
+        raise NotImplementedError('not implemented')
+
+    # transactions of the restake functions for the gas cache, with the interface of
+    # utils.scan_explorer. They come from the event indexer; the explorer is only used
+    # for the functions without enough indexed transactions, or whose last transaction
+    # seen (stop hash) isn't indexed.
+    def _scan_restake_txns(self, funcs, N = 10, only_success = False, stop_hashes = None):
+        stop_hashes = [None]*len(funcs) if stop_hashes is None else stop_hashes
+        events = dict(zip([GasUsageCache._get_key(func) for func in self._get_restake_functions()], self._get_restake_events()))
+        txns_list = self.event_indexer.scan(funcs, [events[GasUsageCache._get_key(func)] for func in funcs],
+                                            N = N, only_success = only_success, stop_hashes = stop_hashes)
+
+        missing = [i for i, (txns, stop_hash) in enumerate(zip(txns_list, stop_hashes))
+                   if (stop_hash is None and len(txns) < N) or (stop_hash is not None and not self.event_indexer.has_transaction(stop_hash))]
+        if len(missing) > 0:
+            found = utils.scan_explorer([funcs[i] for i in missing], N = N, only_success = only_success,
+                                        stop_hashes = [stop_hashes[i] for i in missing])
+            for i, txns in zip(missing, found):
+                txns_list[i] = txns
+        return txns_list
         
-        gain_rate = total_reward/total_staking*reward_staking_price_ratio/t # gain per second
+    # to_block: latest block, if already known
+    def _get_gain_rates(self, reward_staking_price_ratio, to_block = None):
+        self.gain_rate_tracker.update(to_block)
+        return self.gain_rate_tracker.get_gain_rates(reward_staking_price_ratio)
 
-        return gain_rate
+    # window: one of the gain_rate_tracker windows. '1d' is close to the 28800 blocks
+    # used before, with the current block time of ~3 seconds.
+    def _get_gain_rate(self, reward_staking_price_ratio, window = '1d'):
+        return self._get_gain_rates(reward_staking_price_ratio)[window] # gain per second
 
     def _restake(self):
         raise NotImplementedError('restaking not implemented') 
@@ -237,14 +300,54 @@ class Restaker:
             raise Exception('more than one log found')
         return logs[0]
     
+    # lock of the wallet, shared with the other processes using it
+    def _get_wallet_lock(self):
+        return FileLock(os.path.join(os.path.dirname(__file__), self.wallet.address + '.lock'))
+
+    # Holds the wallet lock over several sends, so they get consecutive local nonces
+    # (e.g. the pipelined restake). Outside of a burst, each send locks the wallet alone
+    # and reads the pending nonce again, as other processes may have used the wallet
+    # while the lock was released (e.g. during a receipt wait).
+    @contextmanager
+    def _transaction_burst(self):
+        with self._get_wallet_lock():
+            self.nonce_manager.reset()
+            self._in_burst = True
+            try:
+                yield
+            finally:
+                self._in_burst = False
+
+    # params: transaction params. With an explicit 'gas', the gas is not estimated, so the
+    # transaction can depend on others not mined yet. 'gasPrice' is read from the node if
+    # not given. The nonce comes from the wallet nonce manager.
     def _send_signed_transaction(self, call, params={}):
-        with FileLock(os.path.join(os.path.dirname(__file__), self.wallet.address + '.lock')):
+        if self._in_burst:
+            return self._send_signed_transaction_locked(call, params)
+        with self._transaction_burst():
+            return self._send_signed_transaction_locked(call, params)
+
+    def _send_signed_transaction_locked(self, call, params):
+        params = dict(params)
+        if 'gasPrice' not in params:
             params['gasPrice'] = self.ronin_chain.eth.gas_price
-            params['nonce'] = self.ronin_chain.eth.get_transaction_count(self.wallet.address, block_identifier = 'pending')
-            params['from'] = self.wallet.address
+        params['nonce'] = self.nonce_manager.get_nonce()
+        params['from'] = self.wallet.address
 
-            txn = call.build_transaction(params)
-            
+        try:
+            txn_hash = self._sign_and_send(call, params)
+        except Exception as e:
+            # the nonce was not used
+            self.nonce_manager.reset()
+            raise e
+        self._sent_calls[txn_hash] = call
+
+        return txn_hash
+
+    def _sign_and_send(self, call, params):
+        txn = call.build_transaction(params)
+
+        if 'gas' not in params:
             # Gas estimate, as described in Eth.send_transaction(transaction):
             #
             # If the transaction specifies a data value but does not specify gas then the gas 
@@ -259,21 +362,19 @@ class Restaker:
 
             txn['gas'] = min(txn['gas'] + 100000, gas_limit)
 
-            signed_txn = self.wallet.sign_transaction(txn)
-            txn_hash = self.ronin_chain.eth.send_raw_transaction(signed_txn.rawTransaction)
-            
-            return txn_hash
-
-    def _wait_txn_receipt(self, txn_hash):
-        timeouts = [3]*5 + [10]*5 + [60]*5 + [5*60]
-        time_idx = 0
-        while True:
-            sleep(timeouts[time_idx])
-            if time_idx < len(timeouts)-1:
-                time_idx += 1
-            try:
-                return self.ronin_chain.eth.get_transaction_receipt(txn_hash)
-            except:
-                pass
+        signed_txn = self.wallet.sign_transaction(txn)
+        return self.ronin_chain.eth.send_raw_transaction(signed_txn.rawTransaction)
+
+    def _wait_txn_receipt(self, txn_hash, timeout = None):
+        return self._wait_txn_receipts([txn_hash], timeout)[0]
+
+    # all hashes are watched at once, so receipts mined in the same block arrive together
+    def _wait_txn_receipts(self, txn_hashes, timeout = None):
+        futures = [self.receipt_poller.watch(txn_hash, timeout) for txn_hash in txn_hashes]
+        txn_receipts = [future.result() for future in futures]
 
-        raise Exception('can not get transaction receipt')
\ No newline at end of file
+        for txn_hash, txn_receipt in zip(txn_hashes, txn_receipts):
+            call = self._sent_calls.pop(txn_hash, None)
+            if call is not None:
+                self._gas_cache.add_receipt(call, txn_receipt)
+        return txn_receipts
\ No newline at end of file
@@ -0,0 +1,118 @@
+from collections import namedtuple
+from threading import Lock
+from time import time
+
+StakingState = namedtuple('StakingState', ['block_number', 'timestamp', 'pending_rewards', 'staking_amount',
+                                           'last_claimed_timestamp', 'can_claim_rewards', 'min_claimed_time_window',
+                                           'projected'])
+
+# Local model of the rewards accrued by a wallet in a staking pool.
+#
+# The rewards accrue deterministically between the events of the wallet (stake, unstake
+# and claim): each block, the pool reward is split by the staked amounts. So after one
+# snapshot (pending rewards, staked amount, pool total and reward per block, all pinned
+# to the same block), the pending rewards are projected forward with no RPC.
+#
+# The model is dropped when the wallet is seen in a RewardClaimed, Staked or Unstaked
+# event already in the event indexer (if any; the indexer is updated by its owner),
+# when invalidate() is called (e.g. after a restake), or after max_age seconds, which
+# bounds the drift caused by other wallets changing the pool total. Projected states
+# should be confirmed on chain before acting.
+class RewardModel:
+    def __init__(self, restaker, event_indexer = None, max_age = 60*60, block_time = 3):
+        self.restaker = restaker
+        self.event_indexer = event_indexer
+        self.max_age = max_age
+        self.block_time = block_time # refined from consecutive snapshots
+
+        self._lock = Lock()
+        self._snapshot = None
+        self._seeded = 0
+        self._last_seed = None # (block, timestamp), to measure the block time
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+    # calls of a snapshot, to be pinned to block (the reward per block is the one of block)
+    def get_staking_calls(self, block):
+        restaker = self.restaker
+        pool_addr, wallet_addr = restaker.staking_pool.address, restaker.wallet.address
+        return {'pending_rewards': restaker.staking_pool.functions.getPendingRewards(wallet_addr),
+                'staking_amount': restaker.staking_pool.functions.getStakingAmount(wallet_addr),
+                'user_reward_info': restaker.staking_manager.functions.userRewardInfo(pool_addr, wallet_addr),
+                'can_claim_rewards': restaker.staking_manager.functions.canObtainRewards(pool_addr, wallet_addr),
+                'min_claimed_time_window': restaker.staking_manager.functions.minClaimedTimeWindow(),
+                'staking_total': restaker.staking_pool.functions.getStakingTotal(),
+                'block_reward': restaker.staking_manager.functions.getBlockReward(pool_addr, block)}
+
+    # record: multicall plan record with the get_staking_calls fields, the block number
+    # and the block timestamp (e.g. a chain snapshot)
+    def seed_from(self, record):
+        block, timestamp = record.block_number, record.timestamp
+        with self._lock:
+            if self._last_seed is not None and block > self._last_seed[0]:
+                self.block_time = (timestamp - self._last_seed[1])/(block - self._last_seed[0])
+            self._last_seed = (block, timestamp)
+
+            self._snapshot = {'block_number': block,
+                              'timestamp': timestamp,
+                              'pending_rewards': record.pending_rewards,
+                              'staking_amount': record.staking_amount,
+                              'last_claimed_timestamp': record.user_reward_info.lastClaimedTimestamp,
+                              'can_claim_rewards': record.can_claim_rewards,
+                              'min_claimed_time_window': record.min_claimed_time_window,
+                              'staking_total': record.staking_total,
+                              'block_reward': record.block_reward}
+            self._seeded = time()
+            return self._get_state(self._snapshot, block, timestamp, False)
+
+    def _has_wallet_events(self, from_block):
+        if self.event_indexer is None:
+            return False
+        restaker = self.restaker
+        for event in ['RewardClaimed', 'Staked', 'Unstaked']:
+            events = self.event_indexer.get_events(address = restaker.staking_pool.address, event = event, from_block = from_block)
+            if any([e['args']['_user'] == restaker.wallet.address for e in events]):
+                return True
+        return False
+
+    def is_valid(self):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or time() - self._seeded > self.max_age:
+                return False
+
+        if self._has_wallet_events(snapshot['block_number'] + 1):
+            self.invalidate()
+            return False
+        return True
+
+    def _get_state(self, snapshot, block, timestamp, projected):
+        blocks = block - snapshot['block_number']
+        pending_rewards = snapshot['pending_rewards']
+        if snapshot['staking_total'] > 0:
+            pending_rewards += blocks*snapshot['block_reward']*snapshot['staking_amount']//snapshot['staking_total']
+
+        can_claim_rewards = snapshot['can_claim_rewards']
+        if projected:
+            # the claim window may have passed since the snapshot
+            last_claim_elapsed_time = timestamp - snapshot['last_claimed_timestamp']
+            can_claim_rewards = can_claim_rewards or last_claim_elapsed_time >= snapshot['min_claimed_time_window']
+        return StakingState(block, timestamp, pending_rewards, snapshot['staking_amount'],
+                            snapshot['last_claimed_timestamp'], can_claim_rewards,
+                            snapshot['min_claimed_time_window'], projected)
+
+    # state projected to time t (default: now), with no RPC. If the block at t is known,
+    # it is used instead of the block time estimate.
+    def project(self, t = None, block = None):
+        with self._lock:
+            snapshot = self._snapshot
+            block_time = self.block_time
+        if snapshot is None:
+            raise Exception('reward model not seeded')
+
+        t = time() if t is None else t
+        if block is None:
+            block = snapshot['block_number'] + max(0, int((t - snapshot['timestamp'])/block_time))
+        return self._get_state(snapshot, block, t, True)
@@ -0,0 +1,123 @@
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from collections import deque
+from time import time
+from web3._utils.request import make_post_request
+from batch_provider import BatchHTTPProvider
+
+# Latency and error rate of an RPC endpoint, as exponentially weighted moving averages.
+# The recent latencies are also kept, for the hedging delay percentile.
+class Endpoint:
+    def __init__(self, url, alpha = 0.2, samples = 50):
+        self.url = url
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0
+        self.last_used = 0
+
+        self._lock = Lock()
+        self._latencies = deque(maxlen = samples)
+
+    def add_result(self, latency, error):
+        with self._lock:
+            self.last_used = time()
+            self.error_rate = (1 - self.alpha)*self.error_rate + self.alpha*(1 if error else 0)
+            if not error:
+                self.latency = latency if self.latency is None else (1 - self.alpha)*self.latency + self.alpha*latency
+                self._latencies.append(latency)
+
+    def get_latency_quantile(self, q):
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) == 0:
+            return None
+        return latencies[min(int(q*len(latencies)), len(latencies) - 1)]
+
+# Batching provider over a pool of RPC endpoints of the same chain.
+#
+# Reads (and read batches) go to the healthy endpoint with the lowest latency. If the
+# response takes longer than the hedge_quantile of its recent latencies, the same
+# request is also sent to the next endpoint and the first response wins, so a latency
+# spike of one node doesn't stall the callers. Endpoints with an error rate above
+# max_error_rate are avoided, but retried after retry_time seconds. Transactions are
+# broadcast to all endpoints.
+class RpcPoolProvider(BatchHTTPProvider):
+    def __init__(self, endpoint_uris, request_kwargs = None, hedge_quantile = 0.9, min_hedge_delay = 0.2,
+                 max_error_rate = 0.5, retry_time = 60, max_workers = 16, **kwargs):
+        super().__init__(endpoint_uris[0], request_kwargs, **kwargs)
+        self.endpoints = [Endpoint(url) for url in endpoint_uris]
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.max_error_rate = max_error_rate
+        self.retry_time = retry_time
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+
+    # endpoints, best first: healthy ones (or not tried for a while) by latency, then the others
+    def _rank_endpoints(self):
+        now = time()
+        def key(endpoint):
+            healthy = endpoint.error_rate <= self.max_error_rate or now - endpoint.last_used > self.retry_time
+            latency = 0 if endpoint.latency is None else endpoint.latency # untried endpoints get a chance
+            return (not healthy, latency if healthy else endpoint.error_rate)
+        return sorted(self.endpoints, key = key)
+
+    def _post_to(self, endpoint, data):
+        start = time()
+        try:
+            response = make_post_request(endpoint.url, data, **self.get_request_kwargs())
+        except Exception as e:
+            endpoint.add_result(time() - start, True)
+            raise e
+        endpoint.add_result(time() - start, False)
+        return response
+
+    def _get_hedge_delay(self, endpoint):
+        delay = endpoint.get_latency_quantile(self.hedge_quantile)
+        return self.min_hedge_delay if delay is None else max(self.min_hedge_delay, delay)
+
+    def _post(self, data):
+        endpoints = self._rank_endpoints()
+        futures = [self.executor.submit(self._post_to, endpoints[0], data)]
+
+        done, _ = wait(futures, timeout = self._get_hedge_delay(endpoints[0]))
+        if len(done) == 0 or futures[0].exception() is not None:
+            # slow or failed: hedge (or retry) on the next endpoint
+            if len(endpoints) > 1:
+                futures.append(self.executor.submit(self._post_to, endpoints[1], data))
+
+        pending = set(futures)
+        error = None
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception() if error is None else error
+        raise error
+
+    def make_request(self, method, params):
+        if method == 'eth_sendRawTransaction':
+            return self._broadcast(self.encode_rpc_request(method, params))
+        if method not in BatchHTTPProvider._batched_methods:
+            return self.decode_rpc_response(self._post(self.encode_rpc_request(method, params)))
+        return super().make_request(method, params)
+
+    # sends to all endpoints. A node may answer with an error (e.g. already known) while
+    # another accepts it, so a successful response is preferred.
+    def _broadcast(self, data):
+        futures = [self.executor.submit(self._post_to, endpoint, data) for endpoint in self.endpoints]
+
+        error_response = None
+        error = None
+        for future in as_completed(futures):
+            if future.exception() is not None:
+                error = future.exception() if error is None else error
+                continue
+            response = self.decode_rpc_response(future.result())
+            if 'error' not in response:
+                return response
+            error_response = response if error_response is None else error_response
+
+        if error_response is not None:
+            return error_response
+        raise error
@@ -0,0 +1,137 @@
+from threading import Condition
+from time import time
+import heapq
+import itertools
+
+# Single thread scheduler for many strategies.
+#
+# Each strategy step returns the time to wait before the next one, and the strategy is
+# kept in a timer heap until that deadline. Triggers are polled in the same thread and
+# can wake strategies before their deadline, e.g. when a deposit fixes a low wallet RON
+# balance or the pending rewards jump. HTTP providers can't
+# subscribe to events, so the triggers poll the chain, batching all wallets in one call.
+class Scheduler:
+    def __init__(self, poll_interval = 15, retry_time = 10*60):
+        self.poll_interval = poll_interval
+        self.retry_time = retry_time
+
+        self._cond = Condition()
+        self._heap = [] # (deadline, seq, strategy)
+        self._seqs = {} # strategy -> seq of its valid heap entry
+        self._counter = itertools.count()
+        self._triggers = []
+        self._next_poll = 0
+
+    def add(self, strategy, delay = 0):
+        strategy._print_header()
+        self._schedule(strategy, time() + delay)
+
+    def add_trigger(self, trigger):
+        self._triggers.append(trigger)
+
+    def _schedule(self, strategy, deadline):
+        with self._cond:
+            seq = next(self._counter)
+            self._seqs[strategy] = seq
+            heapq.heappush(self._heap, (deadline, seq, strategy))
+            self._cond.notify()
+
+    # runs the strategy as soon as possible. Can be called from other threads.
+    def wake(self, strategy):
+        self._schedule(strategy, time())
+
+    def _pop_due(self):
+        with self._cond:
+            while True:
+                # drop entries replaced by a newer schedule of the same strategy
+                while len(self._heap) > 0 and self._seqs.get(self._heap[0][2]) != self._heap[0][1]:
+                    heapq.heappop(self._heap)
+
+                now = time()
+                if len(self._heap) > 0 and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                if len(self._triggers) > 0 and self._next_poll <= now:
+                    return None
+
+                timeout = self._heap[0][0] - now if len(self._heap) > 0 else None
+                if len(self._triggers) > 0:
+                    timeout = self._next_poll - now if timeout is None else min(timeout, self._next_poll - now)
+                self._cond.wait(timeout)
+
+    def _poll_triggers(self):
+        self._next_poll = time() + self.poll_interval
+        for trigger in self._triggers:
+            try:
+                strategies = trigger.poll()
+            except Exception:
+                continue # try again in the next poll
+            for strategy in strategies:
+                strategy._print('Woken up by {}.'.format(trigger.__class__.__name__))
+                self.wake(strategy)
+
+    def _run_step(self, strategy):
+        try:
+            sleep_time = strategy._step()
+        except Exception as e:
+            strategy._print_exception(e)
+            if self.retry_time is None:
+                raise e
+            # one failing position must not stop the others
+            strategy._print('Retrying in {:.2f} minutes...'.format(self.retry_time/60))
+            sleep_time = self.retry_time
+        self._schedule(strategy, time() + sleep_time)
+
+    def run(self):
+        if len(self._seqs) == 0:
+            raise Exception('no strategy to run')
+        while True:
+            strategy = self._pop_due()
+            if strategy is None:
+                self._poll_triggers()
+            else:
+                self._run_step(strategy)
+
+# Wakes the strategies parked on a low RON balance when their wallet balance grows since
+# the last poll (a deposit). Other changes are the strategies' own transactions, or the
+# ones of other positions of the same wallet, and must not wake them. The balances of all
+# wallets are read in one multicall (getRonBalance).
+class BalanceTrigger:
+    def __init__(self, multicall2, strategies):
+        self.multicall2 = multicall2
+        self.strategies = strategies
+        self._balances = None
+
+    def poll(self):
+        _, balances = self.multicall2.aggregate([self.multicall2.contract.functions.getRonBalance(strategy.restaker.wallet.address)
+                                                 for strategy in self.strategies]).call()
+        last_balances = self._balances
+        self._balances = balances
+        if last_balances is None:
+            return []
+        return [strategy for strategy, balance, last_balance in zip(self.strategies, balances, last_balances)
+                if strategy._ron_balance_low and balance > last_balance]
+
+# Wakes the strategies whose pending rewards grew more than spike_ratio times the
+# amount expected from the growth observed in the previous poll.
+class PendingRewardsTrigger:
+    def __init__(self, multicall2, strategies, spike_ratio = 3):
+        self.multicall2 = multicall2
+        self.strategies = strategies
+        self.spike_ratio = spike_ratio
+        self._rewards = None
+        self._growths = None
+
+    def poll(self):
+        _, rewards = self.multicall2.aggregate([strategy.restaker.staking_pool.functions.getPendingRewards(strategy.restaker.wallet.address)
+                                                for strategy in self.strategies]).call()
+        last_rewards, last_growths = self._rewards, self._growths
+        self._rewards = rewards
+        if last_rewards is None:
+            return []
+
+        # rewards going down means they were claimed: not a spike
+        self._growths = [max(0, reward - last_reward) for reward, last_reward in zip(rewards, last_rewards)]
+        if last_growths is None:
+            return []
+        return [strategy for strategy, growth, last_growth in zip(self.strategies, self._growths, last_growths)
+                if last_growth > 0 and growth > self.spike_ratio*last_growth]
@@ -0,0 +1,47 @@
+from concurrent.futures import wait, FIRST_COMPLETED
+from time import time
+
+# Dependency graph of independent fetch stages, run on a (bounded) thread pool.
+#
+# Each stage is a function receiving the results of the stages done so far, and starts
+# as soon as all its dependencies are done, so the wall-clock time is the one of the
+# slowest chain of stages instead of the sum of all of them. The time of each stage is
+# measured, to be logged by the caller.
+class StageGraph:
+    def __init__(self, executor):
+        self.executor = executor
+        self._stages = {} # name -> (func, dependencies)
+
+    def add(self, name, func, dependencies = []):
+        for dependency in dependencies:
+            if dependency not in self._stages:
+                raise Exception('unknown stage {}'.format(dependency))
+        self._stages[name] = (func, dependencies)
+
+    def _run_stage(self, name, func, results):
+        start = time()
+        result = func(results)
+        return name, result, time() - start
+
+    # returns the results and the times of the stages, by name. The first failing stage
+    # raises its exception (stages already running are left to finish in the background).
+    def run(self):
+        results = {}
+        timings = {}
+        waiting = dict(self._stages)
+        running = set()
+
+        while len(waiting) > 0 or len(running) > 0:
+            ready = [name for name, (_, dependencies) in waiting.items() if all([d in results for d in dependencies])]
+            for name in ready:
+                func, _ = waiting.pop(name)
+                # each stage gets a copy, as the results keep being added
+                running.add(self.executor.submit(self._run_stage, name, func, dict(results)))
+
+            done, running = wait(running, return_when = FIRST_COMPLETED)
+            for future in done:
+                name, result, elapsed = future.result()
+                results[name] = result
+                timings[name] = elapsed
+
+        return results, timings
@@ -3,8 +3,8 @@ from .interval_strategy import IntervalStrategy
 
 class ASAPStrategy(IntervalStrategy):
 
-    def __init__(self, restaker : Restaker):
-        super().__init__(restaker)
+    def __init__(self, restaker : Restaker, gas_quantile = 0.5, pipelined = False):
+        super().__init__(restaker, gas_quantile, pipelined)
 
     def _get_time_to_restake(self, rewards_ron, fees_estimated_ron, staked_ron, gain_rate):
         return 0 # as soon as possible!
@@ -1,33 +1,74 @@
 from .strategy import Strategy
 from restaker import Restaker
-from time import time, sleep
+from reward_model import RewardModel
+from chain_snapshot import ChainSnapshotReader
+from stage_graph import StageGraph
+from concurrent.futures import ThreadPoolExecutor
+from time import time
 
 class IntervalStrategy(Strategy):
+    # fetch stages of the decisions, shared by all strategies of the process
+    _executor = ThreadPoolExecutor(max_workers = 8)
 
-    def __init__(self, restaker : Restaker):
-        super().__init__(restaker)
+    # gas_quantile: quantile of the gas used history used to budget the fees (0.5 for the median, 0.9 for p90)
+    def __init__(self, restaker : Restaker, gas_quantile = 0.5, pipelined = False):
+        super().__init__(restaker, pipelined)
+        self.gas_quantile = gas_quantile
+        self.reward_model = RewardModel(restaker, restaker.event_indexer)
+        self.snapshot_reader = ChainSnapshotReader(restaker, self.reward_model)
 
-    def _loop(self):
+    # independent fetches of a decision, started as soon as their inputs are known:
+    # the snapshot, the exchange rates, the gas history and the new events of the pool
+    # in parallel, then the prices and the gain rate samples, both pinned to the
+    # snapshot block.
+    def _get_stages(self):
         restaker = self.restaker
-        r = restaker.multicall2.aggregate([
-                    restaker.staking_pool.functions.getPendingRewards(restaker.wallet.address),
-                    restaker.staking_pool.functions.getStakingAmount(restaker.wallet.address),
-                    restaker.staking_manager.functions.userRewardInfo(restaker.staking_pool.address, restaker.wallet.address),
-                    restaker.staking_manager.functions.canObtainRewards(restaker.staking_pool.address, restaker.wallet.address),
-                    restaker.staking_manager.functions.minClaimedTimeWindow()]).call()
-        block_number = r[0]
-        pending_rewards = r[1][0]
-        staking_amount = r[1][1]
-        last_claimed_timestamp = r[1][2][2]
-        can_claim_rewards = r[1][3]
-        min_claimed_time_window = r[1][4]
+        graph = StageGraph(IntervalStrategy._executor)
+        graph.add('snapshot', lambda r: self.snapshot_reader.read())
+        graph.add('price_feed', lambda r: Restaker._price_feed.get())
+        graph.add('gas_estimated', lambda r: restaker._estimate_gas_to_restake(q = self.gas_quantile))
+        graph.add('events', lambda r: restaker.event_indexer.update())
+        graph.add('prices', lambda r: restaker._get_tokens_prices_usd(r['snapshot'].state), ['snapshot', 'price_feed'])
+        graph.add('gain_samples', lambda r: restaker.gain_rate_tracker.update(r['snapshot'].block_number), ['snapshot'])
+        return graph
+
+    def _run_stages(self):
+        start = time()
+        results, timings = self._get_stages().run()
+        self._print('Fetch times: {} (total {:.2f}s)'.format(', '.join(['{} {:.2f}s'.format(name, elapsed)
+                                                                      for name, elapsed in timings.items()]),
+                                                            time() - start))
+        return results
+
+    # runs one decision and returns the time (in seconds) to wait before the next one
+    def _step(self):
+        restaker = self.restaker
+        results = self._run_stages()
+        # the whole decision works from one snapshot. The pending rewards are projected
+        # by the local model, read from the chain only when the model is invalid or expired.
+        snapshot = results['snapshot']
+        self._ron_balance = snapshot.ron_balance
+        state = snapshot.staking_state
+        if state.projected and not self.reward_model.is_valid():
+            # e.g. the wallet was seen in a pool event indexed in this step
+            self._print('Reward model invalidated, reading the rewards on chain...')
+            return 0
+
+        pending_rewards = state.pending_rewards
+        staking_amount = state.staking_amount
+        last_claimed_timestamp = state.last_claimed_timestamp
+        can_claim_rewards = state.can_claim_rewards
+        min_claimed_time_window = state.min_claimed_time_window
 
         # TODO: futuramente, calcular todos preços internamente ao chain, calculando em relação a USDC (ou RON)
         # TODO: tentar usar get https://exchange-rate.axieinfinity.com/
-        staking_token_price, reward_token_price, wron_token_price = restaker._get_tokens_prices_usd()
+        staking_token_price, reward_token_price, wron_token_price = results['prices']
 
-        gain_rate = restaker._get_gain_rate(reward_token_price/staking_token_price, N=28800)
-        self._print('Estimated APR: {:.2f}%'.format(100*gain_rate*60*60*24*365))
+        # samples already updated to the snapshot block by its stage
+        gain_rates = restaker._get_gain_rates(reward_token_price/staking_token_price, snapshot.block_number)
+        self._print('Estimated APR: {}'.format(', '.join(['{:.2f}% ({})'.format(100*rate*60*60*24*365, window)
+                                                         for window, rate in gain_rates.items()])))
+        gain_rate = gain_rates['1d']
 
         staked_ron = staking_amount * staking_token_price/wron_token_price
         staked_usd = staking_amount*staking_token_price*10**(-restaker.staking_token_decimals)
@@ -41,14 +82,14 @@ class IntervalStrategy(Strategy):
                                                                restaker.reward_token_symbol,
                                                                 rewards_usd))
 
-        gas_price_ron = restaker.ronin_chain.eth.gas_price
+        gas_price_ron = snapshot.gas_price
         gas_price_usd = gas_price_ron*wron_token_price*10**(-restaker.wron_token_decimals)
-        gas_estimated = restaker._estimate_gas_to_restake()
+        gas_estimated = results['gas_estimated']
         gas_estimated_ron = gas_estimated * gas_price_ron
         gas_estimated_usd = gas_estimated * gas_price_usd
         self._print('Estimated gas to restake: {} ({} USD)'.format(gas_estimated, gas_estimated_usd))
 
-        last_claim_elapsed_time = time() - last_claimed_timestamp
+        last_claim_elapsed_time = snapshot.timestamp - last_claimed_timestamp
 
         # total fees are not always a function of gas only, but sometimes also of pending reward, because
         # some restakers need to swap tokens (0.3% fee)
@@ -56,15 +97,24 @@ class IntervalStrategy(Strategy):
         fees_estimated_ron = self._estimate_fees_ron(rewards_ron, gas_estimated_ron)
         if self._is_ron_balance_low(fees_estimated_ron):
             self._print('Sleeping for 10 minutes...')
-            sleep(10*60) # sleep for 10 minutes
-            return
+            return 10*60 # sleep for 10 minutes
         
         time_to_restake = self._get_time_to_restake(rewards_ron, fees_estimated_ron, staked_ron, gain_rate)
 
+        if time_to_restake <= 0 and state.projected:
+            # confirm the projected rewards on chain before acting
+            self._print('Confirming rewards on chain...')
+            self.reward_model.invalidate()
+            return 0
+
         if time_to_restake <= 0:
-            if can_claim_rewards:
+            if can_claim_rewards and not self._is_spot_price_safe(snapshot):
+                self._print('Postponing the restake...')
+                sleep_time = 10*60
+            elif can_claim_rewards:
                 self._print('Restaking...')
-                gas_used = self._restake()
+                gas_used = self._restake(snapshot)
+                self.reward_model.invalidate()
                 self._print('Total gas used: {} ({} USD)'.format(gas_used,
                                                                 gas_used*gas_price_usd))
                 self._print('Gas estimation error: {:.2f}%'.format(100*(gas_used-gas_estimated)/gas_estimated))
@@ -81,7 +131,7 @@ class IntervalStrategy(Strategy):
             sleep_time = min(time_to_restake, 60*60*24)
 
         self._print('Sleeping for {:.2f} days...'.format(sleep_time/60/60/24))
-        sleep(sleep_time)
+        return sleep_time
 
     def _get_time_to_restake(self, rewards_ron, fees_estimated_ron, staked_ron, gain_rate):
         raise Exception('not implemented')
\ No newline at end of file
@@ -4,8 +4,8 @@ from math import exp
 
 class OptimalIntervalStrategy(IntervalStrategy):
 
-    def __init__(self, restaker : Restaker, min_desired_ron_balance = 0):
-        super().__init__(restaker)
+    def __init__(self, restaker : Restaker, min_desired_ron_balance = 0, gas_quantile = 0.5, pipelined = False):
+        super().__init__(restaker, gas_quantile, pipelined)
         self.min_desired_ron_balance = min_desired_ron_balance
 
     def _get_time_to_restake(self, rewards_ron, fees_estimated_ron, staked_ron, gain_rate):
@@ -72,7 +72,7 @@ class OptimalIntervalStrategy(IntervalStrategy):
 
     def _get_usable_ron_balance(self, pending_rewards_ron):
         restaker = self.restaker
-        ron_balance = restaker.ronin_chain.eth.get_balance(restaker.wallet.address)
+        ron_balance = self._get_ron_balance()
         usable_ron_balance = ron_balance - self.min_desired_ron_balance*10**restaker.wron_token_decimals
         if self._is_reward_added_to_ron_balance():
             usable_ron_balance += pending_rewards_ron
@@ -87,14 +87,14 @@ class OptimalIntervalStrategy(IntervalStrategy):
         else:
             raise NotImplementedError('method not implemented for {} class'.format(restaker.__class__.__name__))
 
-    def _get_usable_reward(self, claimed_reward, gas_used_claim):
+    def _get_usable_reward(self, claimed_reward, gas_used_claim, ron_balance = None):
         restaker : KatanaRestaker = self.restaker
 
         assert restaker.reward_token.address.lower() == Restaker._wron_token_addr.lower(), 'Reward token is not WRON!'
 
         self._print('Estimating usable rewards...')
         gas_price_ron = restaker.ronin_chain.eth.gas_price
-        gas_estimated = restaker._estimate_gas_to_restake()
+        gas_estimated = restaker._estimate_gas_to_restake(q = self.gas_quantile)
         gas_estimated_ron = gas_price_ron * gas_estimated
         usable_reward = claimed_reward - gas_estimated_ron
         if usable_reward <= 0:
@@ -102,7 +102,8 @@ class OptimalIntervalStrategy(IntervalStrategy):
             self._print('Restaking aborted.')
             return
         estimated_remaining_gas_ron = gas_estimated_ron - gas_used_claim * gas_price_ron
-        ron_balance = restaker.ronin_chain.eth.get_balance(restaker.wallet.address)
+        if ron_balance is None:
+            ron_balance = restaker.ronin_chain.eth.get_balance(restaker.wallet.address)
         # Here it is! The control loop to make the RON balance follow the min_desired_ron_balance closely
         deviation_from_desired_ron_balance = ron_balance - estimated_remaining_gas_ron - self.min_desired_ron_balance*10**restaker.wron_token_decimals
         usable_reward = min(usable_reward, deviation_from_desired_ron_balance)
@@ -1,10 +1,15 @@
 from logger import Logger
+from scheduler import Scheduler, BalanceTrigger
 from restaker import Restaker, KatanaRestaker, AXSRestaker
 
 class Strategy:
 
-    def __init__(self, restaker : Restaker):
+    # pipelined: send the Katana restake transactions back-to-back (see _katana_restake_pipelined)
+    def __init__(self, restaker : Restaker, pipelined = False):
         self.restaker = restaker
+        self.pipelined = pipelined
+        self._ron_balance = None # read in the current step
+        self._ron_balance_low = False # parked until a deposit, see BalanceTrigger
         self.logger = Logger('log_{}.txt'.format(restaker.staking_token_symbol))
 
     def _print(self, msg):
@@ -15,31 +20,40 @@ class Strategy:
                                             e.__str__()))
 
     def run(self):
+        # woken up at the deadline returned by _step or by a deposit while the RON balance is low
+        scheduler = Scheduler(retry_time = None)
+        scheduler.add(self)
+        scheduler.add_trigger(BalanceTrigger(self.restaker.multicall2, [self]))
+        if isinstance(self.restaker, KatanaRestaker):
+            scheduler.add_trigger(self.restaker.twap_sampler)
+        scheduler.run()
+
+    def _print_header(self):
         self._print('##### Restaker #####')
         self._print('Strategy: {}'.format(self.__class__.__name__))
         self._print('Staking pool: {} ({})'.format(self.restaker.staking_token_symbol,
                                                    self.restaker.staking_pool.address))
         self._print('Wallet: {}'.format(self.restaker.wallet.address))
 
-        while True:
-            try:
-                self._loop()
-            except BaseException as e:
-                self._print_exception(e)
-                raise e
+    def _step(self):
+        raise NotImplementedError('step not implemented')
 
-    def _loop(self):
-        raise NotImplemented('loop not implemented')
+    def _get_ron_balance(self):
+        if self._ron_balance is not None:
+            return self._ron_balance
+        return self.restaker.ronin_chain.eth.get_balance(self.restaker.wallet.address)
 
     def _is_ron_balance_low(self, fees_estimated_ron):
         restaker : Restaker = self.restaker
-        ron_balance = restaker.ronin_chain.eth.get_balance(restaker.wallet.address)
+        ron_balance = self._get_ron_balance()
         # Using 2x margin for fee estimation vs. real fee
         if 2*fees_estimated_ron > ron_balance:
             # Using 4x margin for variability in fee estimation in the next loop, to not fall here again
             self._print('RON balance too low. Deposit at least {} RON to continue.'.format((4*fees_estimated_ron-ron_balance)*10**(-restaker.wron_token_decimals)))
+            self._ron_balance_low = True
             return True
         else:
+            self._ron_balance_low = False
             return False
         
     def _estimate_fees_ron(self, pending_rewards_ron, gas_estimated_ron):
@@ -55,9 +69,24 @@ class Strategy:
 
         return fees_estimated_ron
     
-    def _restake(self):
+    # False while the Katana pair spot price deviates too much from its TWAP, to postpone
+    # the restake before anything is sent
+    def _is_spot_price_safe(self, snapshot = None):
         restaker = self.restaker
-        if isinstance(restaker, KatanaRestaker):
+        if not isinstance(restaker, KatanaRestaker):
+            return True
+        deviation = restaker.get_spot_price_deviation(None if snapshot is None else restaker.get_pair_snapshot_from(snapshot.state))
+        if abs(deviation) > restaker._max_twap_deviation:
+            self._print('Spot price deviates {:.2f}% from the TWAP.'.format(100*deviation))
+            return False
+        return True
+
+    # snapshot: chain snapshot of the decision, if any, to size the pipelined restake from
+    def _restake(self, snapshot = None):
+        restaker = self.restaker
+        if isinstance(restaker, KatanaRestaker) and self.pipelined:
+            return self._katana_restake_pipelined(snapshot)
+        elif isinstance(restaker, KatanaRestaker):
             return self._katana_restake()
         elif isinstance(restaker, AXSRestaker):
             return self._axs_restake()
@@ -75,13 +104,18 @@ class Strategy:
 
         usable_reward = self._get_usable_reward(claimed_reward, gas_used_claim)
 
-        reward_to_swap = round(usable_reward/2)
+        # the whole restake is sized from a single reserves snapshot, read after the claim
+        # is mined, as the pair may have moved since the decision. The swapped part is
+        # slightly more than half, to compensate the swap fee and the price impact.
+        sizing = restaker.size_restake(usable_reward)
+        reward_to_swap = sizing.ron_to_swap
         self._print('Swapping {} {}...'.format(reward_to_swap*10**(-restaker.reward_token_decimals), restaker.reward_token_symbol))
-        swapped_amount, gas_used_swap = restaker.swap_ron_for_token(reward_to_swap)
+        swapped_amount, gas_used_swap = restaker.swap_ron_for_token(reward_to_swap, sizing.token_amount)
 
-        token = restaker.token1 if restaker.token0.address == restaker.wron_token.address else restaker.token0
-        _, [token_decimals, token_symbol] = restaker.multicall2.aggregate([token.functions.decimals(),
-                                                                         token.functions.symbol()]).call()
+        if restaker.token0.address == restaker.wron_token.address:
+            token_decimals, token_symbol = restaker.token1_decimals, restaker.token1_symbol
+        else:
+            token_decimals, token_symbol = restaker.token0_decimals, restaker.token0_symbol
         self._print('Swapped {} {}.'.format(swapped_amount*10**(-token_decimals), token_symbol))
 
         self._print('Adding liquidity...')
@@ -94,7 +128,61 @@ class Strategy:
 
         return gas_used_claim + gas_used_swap + gas_used_add_liquidity + gas_used_stake
 
-    def _get_usable_reward(self, claimed_reward, gas_used_claim):
+    # The claim, swap and add liquidity are sized from the pending rewards and one reserves
+    # snapshot, then sent back-to-back with consecutive nonces. Only the stake waits for
+    # them, because the minted amount is known only after the deposit. So the whole
+    # restake takes about two blocks instead of four receipt waits.
+    def _katana_restake_pipelined(self, snapshot = None):
+        assert isinstance(self.restaker, KatanaRestaker), '{} class different from {}'.format(self.restaker.__class__.__name__,
+                                                                                              KatanaRestaker.__name__)
+        restaker : KatanaRestaker = self.restaker
+
+        if snapshot is None:
+            state = restaker.get_restake_state()
+            gas_price = restaker.ronin_chain.eth.gas_price
+        else:
+            # the restake only happens on pending rewards read from the chain (not projected)
+            state = KatanaRestaker.RestakeState(snapshot.staking_state.pending_rewards, snapshot.ron_balance,
+                                                restaker.get_pair_snapshot_from(snapshot.state))
+            gas_price = snapshot.gas_price
+        gas_limits = restaker._get_restake_gas_limits()
+
+        # the claim is not mined yet: use its expected result
+        gas_claim_ron = gas_limits[0]*gas_price
+        ron_balance_after_claim = state.ron_balance + state.pending_rewards - gas_claim_ron
+        usable_reward = self._get_usable_reward(state.pending_rewards, gas_limits[0], ron_balance_after_claim)
+        if usable_reward is None:
+            return 0 # aborted before sending anything
+
+        sizing = restaker.size_restake(usable_reward, state.snapshot)
+        # the swap and the deposit are sent before the claim is mined, so the RON balance
+        # after the claim must cover all their values at once. The sequential restake
+        # sends each transaction once the previous one is mined, so it needs less.
+        if restaker.get_pipelined_restake_cost(sizing, state.snapshot, gas_limits, gas_price) > ron_balance_after_claim:
+            self._print('RON balance too low to pipeline the restake, restaking sequentially...')
+            return self._katana_restake()
+
+        self._print('Claiming rewards and swapping {} {}...'.format(sizing.ron_to_swap*10**(-restaker.reward_token_decimals),
+                                                                    restaker.reward_token_symbol))
+        txn_hashes = restaker.send_pipelined_restake(sizing, state.snapshot, gas_limits, gas_price)
+        claim_txn_rec, swap_txn_rec, liquidity_txn_rec = restaker._wait_txn_receipts(txn_hashes)
+
+        # if the claim failed, the other transactions may have used the RON balance
+        claimed_reward, gas_used_claim = restaker.get_claim_result(claim_txn_rec)
+        self._print('Claimed {} {}.'.format(claimed_reward*10**(-restaker.reward_token_decimals), restaker.reward_token_symbol))
+        swapped_amount, gas_used_swap = restaker.get_swap_result(swap_txn_rec)
+        minted_amount, gas_used_add_liquidity = restaker.get_add_liquidity_result(liquidity_txn_rec)
+        self._print('Minted {} {}.'.format(minted_amount*10**(-restaker.staking_token_decimals), restaker.staking_token_symbol))
+
+        self._print('Staking {} {}...'.format(minted_amount*10**(-restaker.staking_token_decimals), restaker.staking_token_symbol))
+        stake_txn_hash = restaker.send_stake(minted_amount, {'gas': gas_limits[3], 'gasPrice': gas_price})
+        gas_used_stake = restaker.get_stake_result(restaker._wait_txn_receipt(stake_txn_hash))
+        self._print('Staked {} {}.'.format(minted_amount*10**(-restaker.staking_token_decimals), restaker.staking_token_symbol))
+
+        return gas_used_claim + gas_used_swap + gas_used_add_liquidity + gas_used_stake
+
+    # ron_balance: balance after the claim. If not given, it is read from the node.
+    def _get_usable_reward(self, claimed_reward, gas_used_claim, ron_balance = None):
         return claimed_reward
 
     def _axs_restake(self):
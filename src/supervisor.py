@@ -0,0 +1,146 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import keyring
+import sys
+from math import ceil
+from time import time
+from multicall_coalescer import MulticallCoalescer
+from restaker import KatanaRestaker
+from scheduler import Scheduler, BalanceTrigger, PendingRewardsTrigger
+from positions import create_restaker, create_strategy, parse_strategy_options
+
+# Hosts many strategies in a single process as cooperative asyncio tasks.
+#
+# Each strategy step (RPC reads, explorer requests, restaking transactions) is still
+# blocking web3 code, so it runs in a bounded thread pool. The time between steps is
+# an awaitable timer instead of a blocked thread, so idle positions cost only a
+# pending task, and all restakers share the same web3 chain (see Restaker._create_chains).
+#
+# With coalesce=True, the restakers' Multicall2 reads go through a shared MulticallCoalescer
+# and the wake up times are aligned to multiples of tick seconds, so the positions due in
+# the same tick read their state in the same aggregate call.
+#
+# The TWAP samplers of the Katana positions are run as tasks too, every sample_interval
+# seconds, so they sample only while the strategies run.
+class Supervisor:
+    def __init__(self, max_workers = 8, retry_time = 10*60, coalesce = True, tick = 60, sample_interval = 15):
+        self.strategies = []
+        self.samplers = []
+        self.executor = ThreadPoolExecutor(max_workers = max_workers)
+        self.retry_time = retry_time
+        self.coalesce = coalesce
+        self.tick = tick
+        self.sample_interval = sample_interval
+        self._coalescers = {}
+
+    def add(self, strategy):
+        if self.coalesce:
+            restaker = strategy.restaker
+            restaker.multicall2 = self._get_coalescer(restaker.multicall2)
+        if isinstance(strategy.restaker, KatanaRestaker) and strategy.restaker.twap_sampler not in self.samplers:
+            self.samplers.append(strategy.restaker.twap_sampler)
+        self.strategies.append(strategy)
+
+    def _get_coalescer(self, multicall2):
+        if isinstance(multicall2, MulticallCoalescer):
+            return multicall2
+        key = (id(multicall2.eth), multicall2.address)
+        if key not in self._coalescers:
+            self._coalescers[key] = MulticallCoalescer(multicall2)
+        return self._coalescers[key]
+
+    def _align(self, sleep_time):
+        if not self.coalesce or self.tick is None:
+            return sleep_time
+        now = time()
+        return ceil((now + sleep_time)/self.tick)*self.tick - now
+
+    async def _run_strategy(self, strategy):
+        loop = asyncio.get_running_loop()
+        strategy._print_header()
+
+        while True:
+            try:
+                sleep_time = await loop.run_in_executor(self.executor, strategy._step)
+            except Exception as e:
+                # one failing position must not stop the others
+                strategy._print_exception(e)
+                strategy._print('Retrying in {:.2f} minutes...'.format(self.retry_time/60))
+                sleep_time = self.retry_time
+            await asyncio.sleep(self._align(sleep_time))
+
+    async def _run_sampler(self, sampler):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(self.executor, sampler.sample)
+            except Exception:
+                pass # a missing sample only makes the spacing less regular
+            await asyncio.sleep(self.sample_interval)
+
+    async def _run(self):
+        await asyncio.gather(*[self._run_strategy(strategy) for strategy in self.strategies],
+                             *[self._run_sampler(sampler) for sampler in self.samplers])
+
+    def run(self):
+        if len(self.strategies) == 0:
+            raise Exception('no strategy to run')
+        try:
+            asyncio.run(self._run())
+        finally:
+            self.executor.shutdown(wait = False)
+
+# args: one or more positions, in the format pool:strategy[:min_ron_balance],
+# using the same options of main.py. Example:
+#
+#   python supervisor.py 1:2:1 3:1 5:2:0.5
+#
+# With --single-thread, the positions are run by the Scheduler in the main thread. The
+# strategy options of main.py (e.g. --gas-quantile=<q>, --pipelined) apply to all positions.
+#
+if __name__ == '__main__':
+    argv, strategy_options = parse_strategy_options(sys.argv)
+    if len(argv) < 2:
+        raise Exception('no position specified')
+
+    priv_key = keyring.get_password('ronin','priv_key')
+    if priv_key is None:
+        raise Exception('private key not set. Run main.py to set it')
+
+    # --single-thread: run all positions in one thread, woken up by deadlines and triggers
+    single_thread = '--single-thread' in argv[1:]
+    positions = [arg for arg in argv[1:] if arg != '--single-thread']
+    strategies = []
+
+    for position in positions:
+        args = position.split(':')
+        if len(args) not in [2, 3]:
+            raise Exception('invalid position {}'.format(position))
+        desired_pool = int(args[0])
+        desired_strat = int(args[1])
+        if (desired_strat == 1) != (len(args) == 2):
+            raise Exception('invalid position {}'.format(position))
+
+        restaker = create_restaker(priv_key, desired_pool)
+        strategies.append(create_strategy(restaker, desired_strat, float(args[2]) if len(args) == 3 else None,
+                                          strategy_options))
+
+    if len(strategies) == 0:
+        raise Exception('no position specified')
+
+    if single_thread:
+        # all restakers are on the same chain, so any multicall reads the wallets of all
+        multicall2 = strategies[0].restaker.multicall2
+        scheduler = Scheduler()
+        for strat in strategies:
+            scheduler.add(strat)
+        scheduler.add_trigger(BalanceTrigger(multicall2, strategies))
+        scheduler.add_trigger(PendingRewardsTrigger(multicall2, strategies))
+        for sampler in set([strat.restaker.twap_sampler for strat in strategies if isinstance(strat.restaker, KatanaRestaker)]):
+            scheduler.add_trigger(sampler)
+        scheduler.run()
+    else:
+        supervisor = Supervisor()
+        for strat in strategies:
+            supervisor.add(strat)
+        supervisor.run()
@@ -0,0 +1,89 @@
+from threading import Lock
+
+# Q112 fixed point of the Uniswap V2 cumulative prices (UQ112x112)
+Q112 = 2**112
+
+# Sampler of the cumulative prices of a Katana pair, kept in a fixed-size ring buffer,
+# so TWAPs are served from memory with no archive (historical state) queries.
+#
+# It has no thread of its own: it's polled by whatever runs the strategies (a trigger
+# of the Scheduler, or a task of the Supervisor), so it samples only while they run.
+# The spacing of the samples is not regular (missed polls, several blocks in a poll),
+# so the sample about window seconds old is found by its timestamp, with a binary
+# search over the buffer. The cumulative prices only change when the pair is touched,
+# so each sample is brought to the sampled block timestamp with the current reserves,
+# as the Uniswap V2 oracle library does.
+class TwapSampler:
+    def __init__(self, multicall2, pair, size = 960):
+        self.multicall2 = multicall2
+        self.pair = pair
+        self.size = size
+
+        self._lock = Lock()
+        self._timestamps = [0]*size
+        self._cumulative_prices = [(0, 0)]*size
+        self._head = 0 # next position to write
+        self._count = 0
+
+    def sample(self):
+        _, [price0_cumulative, price1_cumulative, reserves, timestamp] = self.multicall2.aggregate([
+            self.pair.functions.price0CumulativeLast(),
+            self.pair.functions.price1CumulativeLast(),
+            self.pair.functions.getReserves(),
+            self.multicall2.contract.functions.getCurrentBlockTimestamp()]).call()
+
+        reserve0, reserve1, last_timestamp = reserves
+        dt = timestamp - last_timestamp
+        if dt > 0 and reserve0 > 0 and reserve1 > 0:
+            price0_cumulative += (reserve1*Q112//reserve0)*dt
+            price1_cumulative += (reserve0*Q112//reserve1)*dt
+
+        with self._lock:
+            if self._count > 0 and self._timestamps[self._head - 1] == timestamp:
+                return # no new block
+            self._timestamps[self._head] = timestamp
+            self._cumulative_prices[self._head] = (price0_cumulative, price1_cumulative)
+            self._head = (self._head + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    # trigger interface of the Scheduler: takes a sample and wakes no strategy
+    def poll(self):
+        self.sample()
+        return []
+
+    # position in the buffer of the i-th oldest sample
+    def _position(self, i):
+        return (self._head - self._count + i) % self.size
+
+    # time covered by the samples, in seconds
+    def get_coverage(self):
+        with self._lock:
+            if self._count < 2:
+                return 0
+            return self._timestamps[self._head - 1] - self._timestamps[(self._head - self._count) % self.size]
+
+    # time weighted average price of token idx, in units of the other token (raw
+    # amounts, as reserves[1-idx]/reserves[idx]), over the last ~window seconds
+    def get_twap(self, idx, window):
+        with self._lock:
+            if self._count < 2:
+                raise Exception('not enough samples')
+
+            newest = (self._head - 1) % self.size
+            # newest sample at least window seconds older than the newest one, or the
+            # oldest sample if none is
+            target = self._timestamps[newest] - window
+            lo, hi = 0, self._count - 2
+            while lo < hi:
+                mid = (lo + hi + 1)//2
+                if self._timestamps[self._position(mid)] <= target:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            oldest = self._position(lo)
+
+            dt = self._timestamps[newest] - self._timestamps[oldest]
+            dp = self._cumulative_prices[newest][idx] - self._cumulative_prices[oldest][idx]
+
+        # the cumulative prices are UQ112x112 fixed point numbers
+        return dp/dt/Q112
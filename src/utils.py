@@ -1,5 +1,10 @@
 from web3 import Web3
-import requests
+from eth_abi.registry import registry
+from eth_abi.encoding import TupleEncoder
+from eth_abi.decoding import TupleDecoder, ContextFramesBytesIO
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+import http_client
 from statistics import median
 
 # Tenta recuperar abi de contrato por API utilizada pelo Ronin Explorer
@@ -8,20 +13,16 @@ def get_contract_abi(contract_addr):
     
     url = 'https://explorer-kintsugi.roninchain.com/v2/2020/contract/{}'.format(contract_addr.lower())
     
-    headers ={'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:95.0) Gecko/20100101 Firefox/95.0',
-              'content-type': 'application/json'}
-    
-    r = requests.get(url, headers = headers)
-    r.raise_for_status()
+    # contracts info rarely changes: cached for a day
+    r = http_client.client.get_json(url, max_age = 24*60*60)
 
-    is_proxy = r.json()['result']['is_proxy']
+    is_proxy = r['result']['is_proxy']
     if is_proxy:
-        proxy_addr = r.json()['result']['proxy_to']
+        proxy_addr = r['result']['proxy_to']
         return get_contract_abi(proxy_addr)
     else:
-        r = requests.get(url + '/abi', headers = headers)
-        r.raise_for_status()
-        return r.json()['result']['output']['abi']
+        r = http_client.client.get_json(url + '/abi', max_age = 24*60*60)
+        return r['result']['output']['abi']
 
 def get_function_abi(func):
     # for bounded functions, the abi is already speficied
@@ -40,16 +41,28 @@ def get_function_abi(func):
         raise Exception('function name not fount in the contract abi')    
     return f_abi[0]
 
+# tuples are described by their components in the abi, but eth_abi and the
+# selector need the canonical type, like (address,bytes)[] for tuple[]
+def get_canonical_type(param):
+    if param['type'].startswith('tuple'):
+        components = ','.join([get_canonical_type(c) for c in param['components']])
+        return '({}){}'.format(components, param['type'][len('tuple'):])
+    return param['type']
+
 def get_input_signature(func):
     abi = get_function_abi(func)
-    input_signature = [fin['type'] for fin in abi['inputs']]
+    input_signature = [get_canonical_type(fin) for fin in abi['inputs']]
     return input_signature
 
 def get_output_signature(func):
     abi = get_function_abi(func)
-    output_signature = [fout['type'] for fout in abi['outputs']]
+    output_signature = [get_canonical_type(fout) for fout in abi['outputs']]
     return output_signature
 
+def get_output_names(func):
+    abi = get_function_abi(func)
+    return [fout['name'] for fout in abi['outputs']]
+
 def get_selector(func):  
     # for bounded functions, the selector is already speficied
     if 'selector' in func.__dict__ and func.selector is not None:
@@ -64,38 +77,121 @@ def get_selector(func):
     input_signature = '({})'.format(input_signature)
     return Web3.keccak(text = func.fn_name + input_signature)[:4]
 
-def get_last_txns_from_explorer(func, N = 10, only_success = False):
-    headers ={'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:95.0) Gecko/20100101 Firefox/95.0',
-              'content-type': 'application/json'}
-    
-    size = 100
-    start_idx = 0
-    info = []
-    hashes = set()
+def get_event_topic(event):
+    input_signature = ','.join([get_canonical_type(ein) for ein in event.abi['inputs']])
+    return Web3.keccak(text = '{}({})'.format(event.abi['name'], input_signature))
+
+# Selector, signatures and eth_abi encoder/decoder of a contract function, computed once.
+# Encoding and decoding are then only the tuple coders and a byte concatenation.
+class FunctionCodec:
+    def __init__(self, selector, input_signature, output_signature):
+        self.selector = selector
+        self.input_signature = input_signature
+        self.output_signature = output_signature
+        self._encoder = TupleEncoder(encoders = [registry.get_encoder(t) for t in input_signature])
+        self._decoder = TupleDecoder(decoders = [registry.get_decoder(t) for t in output_signature])
+
+    def encode(self, args):
+        return self.selector + self._encoder(args)
+
+    def decode(self, data):
+        return self._decoder(ContextFramesBytesIO(data))
+
+_codecs = {}
+_codecs_lock = Lock()
+
+def get_function_codec(func):
+    # the key uses the contract abi identity, so contracts sharing the same parsed abi
+    # share the codecs. For bounded functions, the function abi identifies the overload.
+    bound_abi = func.abi if 'abi' in func.__dict__ and func.abi is not None else None
+    key = (id(func.contract_abi), func.fn_name, id(bound_abi))
 
+    cached = _codecs.get(key)
+    # the contract abi is kept in the cache so its id can't be reused by another object
+    if cached is not None and cached[0] is func.contract_abi:
+        return cached[1]
+
+    codec = FunctionCodec(get_selector(func), get_input_signature(func), get_output_signature(func))
+    with _codecs_lock:
+        _codecs[key] = (func.contract_abi, codec)
+    return codec
+
+def _get_explorer_page(address, offset, size):
     url = 'https://skynet-api.roninchain.com/ronin/txs/search'
 
-    while len(info)<N:
-        data = {'address': {'relateTo': func.address.lower(),},
-                'paging': {'offset': start_idx, 'limit': size,},
-        }
+    data = {'address': {'relateTo': address.lower(),},
+            'paging': {'offset': offset, 'limit': size,},
+    }
+
+    req = http_client.client.post_json(url, data)['result']['items']
+    if(len(req) != size):
+        raise Exception('Results with less items than expected: got {}, expected {}'.format(len(req), size))
+    return req
+
+# Scans the explorer for the last N transactions of several functions at once.
+#
+# The functions are grouped by contract address, so functions of the same contract
+# share the downloaded pages, and each transaction is classified against all their
+# selectors in a single pass. The first page of an address is fetched alone, as it's
+# usually enough for an incremental scan; only when more pages are needed, up to
+# max_workers pages are fetched concurrently. The scan of an address stops as soon as
+# every function has its N transactions.
+#
+# The explorer returns the newest transactions first. If stop_hashes[i] is given,
+# the scan of funcs[i] stops at this transaction, returning only the newer ones
+# (possibly less than N).
+#
+# Returns a list with the transactions of each function, in the order of funcs.
+def scan_explorer(funcs, N = 10, only_success = False, stop_hashes = None, max_workers = 4):
+    size = 100
+    stop_hashes = [None]*len(funcs) if stop_hashes is None else stop_hashes
+    selectors = ['0x' + bytes(get_selector(func)).hex() for func in funcs]
+
+    info = [[] for _ in funcs]
+    done = [False]*len(funcs)
+
+    addresses = []
+    for func in funcs:
+        if func.address not in addresses:
+            addresses.append(func.address)
+
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        for address in addresses:
+            targets = [i for i, func in enumerate(funcs) if func.address == address]
+            hashes = set()
+            start_idx = 0
+            n_pages = 1
+
+            while not all([done[i] for i in targets]):
+                offsets = [start_idx + k*size for k in range(n_pages)]
+                pages = executor.map(lambda offset: _get_explorer_page(address, offset, size), offsets)
+                start_idx += n_pages*size
+                n_pages = max_workers
+
+                for page in pages:
+                    for r in page:
+                        if r['transactionHash'] in hashes:
+                            continue
+                        hashes.add(r['transactionHash'])
 
-        req = requests.post(url, headers = headers, json=data)
-        req.raise_for_status()
+                        for i in targets:
+                            if done[i]:
+                                continue
+                            if r['transactionHash'] == stop_hashes[i]:
+                                done[i] = True
+                            elif r['input'][:10] == selectors[i] and (not only_success or r['status']==1):
+                                info[i].append(r)
+                                done[i] = len(info[i]) >= N
 
-        req = req.json()['result']['items']
-        if(len(req) != size):
-            raise Exception('Results with less items than expected: got {}, expected {}'.format(len(req), size))
-        
-        temp = [r for r in req if r['input'][:10] == get_selector(func).hex() and r['transactionHash'] not in hashes]
-        if only_success == True:
-            temp = [t for t in temp if t['status']==1]
+                    if all([done[i] for i in targets]):
+                        break
 
-        hashes.update([t['transactionHash'] for t in temp])
-        start_idx += size
-        info += temp
+    return [txns[:N] for txns in info]
 
-    return info[:N]
+# the explorer returns the newest transactions first. If stop_hash is given, the scan
+# stops at this transaction, returning only the newer ones (possibly less than N).
+def get_last_txns_from_explorer(func, N = 10, only_success = False, stop_hash = None):
+    return scan_explorer([func], N = N, only_success = only_success, stop_hashes = [stop_hash], max_workers = 1)[0]
 
 def get_gas_used_from_explorer(func, N=10):
     txns = get_last_txns_from_explorer(func = func, N = N, only_success = True)